@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
+import concurrent.futures
 import json
 import random
 import re
@@ -9,7 +11,10 @@ import signal
 import statistics
 import subprocess
 import sys
+import threading
 import time
+import uuid
+import zlib
 import os
 
 import commentjson
@@ -21,6 +26,19 @@ from humanfriendly import parse_timespan, parse_size
 BASEDIR = os.path.join(".", os.path.dirname(sys.argv[0]))
 BASEDIR = os.path.realpath(BASEDIR)
 CONFIG = f"{BASEDIR}/settings.json"
+LOGDIR = f"{BASEDIR}/logs"
+SERIESDIR = f"{BASEDIR}/series"
+
+# collector.py lives next to the get-*.py scripts.
+sys.path.insert(1, os.path.realpath(os.path.join(BASEDIR, "..")))
+
+import collector
+import health
+import ledger
+import logstore
+import series
+import state
+import tagindex
 
 # See sysexits(3).
 EX_OK = 0
@@ -48,14 +66,75 @@ DEFAULT_LOCAL = "127.0.0.1"
 DEFAULT_REPORTER = "127.0.0.1"
 DEFAULT_PORT = 11300
 DEFAULT_SELECT_ALGO = "less-latency"
-DEFAULT_SELECT_ALGOS = ("all", "random", "less-latency", "single")
+DEFAULT_SELECT_ALGOS = ("all", "random", "less-latency", "single", "least-loaded", "best-fit")
 DEFAULT_SELECT_ARG = None
 DEFAULT_TTR = 60 * 60 * 1 # 1h
 DEFAULT_SCRIPTS = os.path.join(BASEDIR, "..")
 DEFAULT_SCRIPTS = os.path.realpath(DEFAULT_SCRIPTS)
 DEFAULT_FORWARD_MAX = 16
+DEFAULT_FORWARD_POLICY = "round-robin"
+DEFAULT_FORWARD_POLICIES = ("round-robin", "capacity", "latency")
 DEFAULT_METRICS_DELAY = 60 * 5 # 5m
 DEFAULT_METRICS_SKEW = 6
+DEFAULT_METRICS_FULL_EVERY = 12
+DEFAULT_LOGS_SEGMENT_SIZE = 1024 * 1024 # 1M
+DEFAULT_LOGS_SEGMENTS = 8
+DEFAULT_STATUS_BATCH_SIZE = 64
+DEFAULT_SERIES_RAW = 60 * 60 * 24 * 7 # 7d
+DEFAULT_SERIES_HOUR = 60 * 60 * 24 * 90 # 90d
+DEFAULT_SERIES_DAY = None # forever
+DEFAULT_WORKER_MAX_JOBS = 0 # unlimited
+DEFAULT_WORKER_MAX_LIFETIME = 0 # unlimited
+DEFAULT_WORKER_POLL = 5
+DEFAULT_WORKER_CONCURRENCY = 1
+DEFAULT_WORKER_OUTPUT_LINES = 1000
+DEFAULT_CAPACITY_TTL = 10
+DEFAULT_CAPACITY_WINDOW = 60 * 5 # 5m
+DEFAULT_CAPACITY_MAX_AGE = None # 3 metrics reports, at least 15m
+DEFAULT_CAPACITY_REPORTS = 3
+DEFAULT_CAPACITY_MIN_AGE = 60 * 15 # 15m
+DEFAULT_LIMITS_RECONCILE = 60 * 60 * 1 # 1h
+DEFAULT_DESTROY_CONCURRENCY = 4
+DEFAULT_DESTROY_IO_CONCURRENCY = 2
+DEFAULT_DESTROY_TIMEOUT = None # (ttr/2)-2
+DEFAULT_POOL_DELAY = 60 # 1m
+DEFAULT_LATENCY_RUNS = 4
+DEFAULT_LATENCY_TIMEOUT = 1
+DEFAULT_LATENCY_DEADLINE = 5
+DEFAULT_LATENCY_GOOD = None # wait for all hosts
+DEFAULT_LATENCY_JOBS = 16
+DEFAULT_HEALTH_INTERVAL = 30
+DEFAULT_HEALTH_MAX_AGE = 60 * 2 # 2m
+DEFAULT_HEALTH_ALPHA = 0.3
+DEFAULT_HEALTH_MAX_FAILURES = 3
+DEFAULT_FANOUT_JOBS = 16
+DEFAULT_ENCODING_FORMAT = "json"
+DEFAULT_ENCODING_FORMATS = ("json", "zlib")
+DEFAULT_ENCODING_THRESHOLD = 1024 # 1K
+
+# Banners of create.sh and deploy.sh reported as progress by the 'create'
+# worker: (prefix, phase).
+PROGRESS_PHASES = (
+    ("Using pooled VM ", "pooled"),
+    ("Creating VM ", "creating"),
+    ("Cloning golden image ", "cloning"),
+    ("Partitioning", "partitioning"),
+    ("Formatting", "formatting"),
+    ("Extracting component ", "extracting"),
+    ("Installing packages", "pkg"),
+    ("Customizing VM ", "customizing"),
+    ("Updating", "freebsd-update"),
+    ("Starting VM ", "starting")
+)
+
+# Jobs encoded as zlib-compressed JSON start with this header, which can never
+# be the beginning of a JSON document. The last byte is the version.
+ZLIB_HEADER = b"\x00cm\x01"
+
+# Globals
+WORKER_STOP = False
+CLIENTS = None
+FORWARD_INDEX = 0
 
 class InvalidAlgorithm(Exception):
     pass
@@ -66,8 +145,13 @@ class ArgumentRequired(Exception):
 class HostNotFound(Exception):
     pass
 
+class InvalidJob(Exception):
+    pass
+
 
 def main(argv):
+    global CLIENTS
+
     try:
         config = getconfig(CONFIG)
     except Exception as e:
@@ -88,6 +172,8 @@ def main(argv):
     cmd = argv[1]
     args = argv[1:]
 
+    CLIENTS = ClientPool()
+
     try:
         if cmd == "create":
             return cmd_create(args, config)
@@ -101,6 +187,14 @@ def main(argv):
             return cmd_destroy(args, config)
         elif cmd == "metrics":
             return cmd_metrics(args, config)
+        elif cmd == "pool":
+            return cmd_pool(args, config)
+        elif cmd == "health":
+            return cmd_health(args, config)
+        elif cmd == "timings":
+            return cmd_timings(args, config)
+        elif cmd == "series":
+            return cmd_series(args, config)
         else:
             usage()
             return EX_USAGE
@@ -110,6 +204,8 @@ def main(argv):
         raise
         err("Exception: %s" % e)
         return EX_SOFTWARE
+    finally:
+        CLIENTS.close()
 
 def cmd_create(argv, config):
     parser = argparse.ArgumentParser(
@@ -117,6 +213,11 @@ def cmd_create(argv, config):
         description="Create a job for virtual machine creation"
     )
 
+    parser.add_argument("--count",
+        help="Number of virtual machines to create (default: %(default)s)",
+        type=int,
+        default=1
+    )
     parser.add_argument("--options",
         help="Options for the virtual machine"
     )
@@ -141,12 +242,17 @@ def cmd_create(argv, config):
 
     args = parser.parse_args(argv[1:])
 
+    count = args.count
     profile = args.profile
     options = args.options
     select_algo = args.select_algo
     select_arg = args.select_arg
     tags = args.tags
 
+    if count < 1:
+        err("Count must be greater than or equal to 1!")
+        return EX_USAGE
+
     if options is not None:
         options = shlex.split(options)
 
@@ -158,461 +264,1512 @@ def cmd_create(argv, config):
         "tags" : tags
     }
 
-    hosts = select_hosts(config.get("hosts"), select_algo, select_arg)
+    if count == 1:
+        hosts = select_hosts(config.get("hosts"), select_algo, select_arg, config, profile)
 
-    for host in hosts:
-        (host, port) = host
+        fan_out(lambda host, port: put(message, "create", host, port, config), hosts)
 
-        try:
-            put(message, "create", host, port, config)
-        except Exception as e:
-            warn("Exception: %s" % e)
+        return EX_OK
 
-    return EX_OK
+    batch_id = uuid.uuid4().hex
 
-def cmd_logs(argv, config):
-    logs = {}
+    info("Batch %s (count:%d)" % (batch_id, count))
 
-    logdir = os.path.join(
-        BASEDIR, "logs"
-    )
+    plan = plan_batch(config.get("hosts"), select_algo, select_arg, config, profile, count)
 
-    logs_files = []
+    index = 0
 
-    if os.path.isdir(logdir):
-        logs_files = sorted(os.listdir(logdir))
+    messages = {}
 
-    for log_file in logs_files:
-        (log_time_str, _) = os.path.splitext(log_file)
+    for host, host_count in plan.items():
+        messages[host] = []
 
-        log_file = os.path.join(logdir, log_file)
+        for _ in range(host_count):
+            messages[host].append(dict(message, batch={
+                "id" : batch_id,
+                "index" : index,
+                "count" : count
+            }))
 
-        with open(log_file) as fd:
-            try:
-                logs[log_time_str] = json.loads(fd.read())
-            except Exception as e:
-                warn("Error reading log '%s': %s" % (log_file, e))
+            index += 1
 
-    print(json.dumps(logs, indent=4))
+    fan_out(lambda host, port: put_many(messages[(host, port)], "create", host, port, config), list(messages))
+
+    print(batch_id)
 
     return EX_OK
 
-def cmd_status(argv, config):
-    reporter = config.get("reporter")
-    (host, port) = parse_host(reporter)
+# Returns how many virtual machines of the batch are sent to each host. The
+# batch is spread by the capacity of each node, except with 'single', which
+# sends it to that host, and 'all', which spreads it over all hosts. The
+# 'least-loaded' and 'best-fit' algorithms are used as such, and the others
+# use 'least-loaded'.
+def plan_batch(hosts, algo, arg, config, profile, count):
+    if algo == "single":
+        return {
+            select_hosts(hosts, algo, arg, config, profile)[0] : count
+        }
 
-    (job, message, client) = watch("status", host, port, parse_json=False)
+    if algo == "all":
+        info("selection:%s = all hosts available" % algo)
 
-    logdir = os.path.join(
-        BASEDIR, "logs"
-    )
+        return spread_batch(hosts, count)
 
-    if not os.path.isdir(logdir):
-        os.makedirs(logdir, exist_ok=True)
+    if algo == "least-loaded" or algo == "best-fit":
+        plan = plan_batch_by_capacity(hosts, algo, profile, count, config)
 
-    logs = config.get("logs")
+        fallback = "less-latency"
+    else:
+        plan = plan_batch_by_capacity(hosts, "least-loaded", profile, count, config)
 
-    remove_after = logs.get("remove-after")
+        fallback = algo
 
-    remove_after_years = remove_after.get("years")
-    remove_after_days = remove_after.get("days")
-    remove_after_hours = remove_after.get("hours")
-    remove_after_minutes = remove_after.get("minutes")
-    remove_after_seconds = remove_after.get("seconds")
-    remove_after_weeks = remove_after.get("weeks")
-    remove_count = remove_after.get("count")
+    planned = sum(plan.values())
 
-    logs_files = os.listdir(logdir)
+    if planned < count:
+        # The capacity of the nodes is unknown or the rest does not fit, so
+        # it is spread over all hosts, starting with the one of 'fallback'.
+        first = select_hosts(hosts, fallback, arg, config, profile)[0]
 
-    if remove_count is not None and \
-            len(logs_files) > remove_count:
-        logs_toremove = set(logs_files[:remove_count])
-    else:
-        logs_toremove = set()
+        warn("Only %d of %d virtual machines fit, spreading the rest over all hosts from %s:%d" % (planned, count, first[0], first[1]))
 
-    if remove_after_years is not None \
-            or remove_after_days is not None \
-            or remove_after_hours is not None \
-            or remove_after_minutes is not None \
-            or remove_after_seconds is not None \
-            or remove_after_weeks is not None:
-        for log_file in logs_files:
-            (log_time_str, _) = os.path.splitext(log_file)
+        ordered = [first] + [host for host in hosts if host != first]
 
-            log_time = int(log_time_str)
+        for host, host_count in spread_batch(ordered, count - planned).items():
+            plan[host] = plan.get(host, 0) + host_count
 
-            _gt = lambda s: (time.time() - log_time) > s
+    return plan
 
-            if remove_after_years is not None \
-                    and _gt(remove_after_years):
-                logs_toremove.add(log_file)
-                continue
+def spread_batch(hosts, count):
+    plan = {}
 
-            if remove_after_days is not None \
-                    and _gt(remove_after_days):
-                logs_toremove.add(log_file)
-                continue
+    for nro in range(count):
+        host = hosts[nro % len(hosts)]
 
-            if remove_after_hours is not None \
-                    and _gt(remove_after_hours):
-                logs_toremove.add(log_file)
-                continue
+        plan[host] = plan.get(host, 0) + 1
 
-            if remove_after_minutes is not None \
-                    and _gt(remove_after_minutes):
-                logs_toremove.add(log_file)
-                continue
+    return plan
+
+def plan_batch_by_capacity(hosts, algo, profile, count, config):
+    nodes = config.get("nodes")
+
+    resources = get_profile_resources(profile, config)
+
+    free = {}
+
+    for node_id, node_capacity in get_nodes_capacity(config).items():
+        host = nodes.get(node_id)
+
+        if host is None or host not in hosts:
+            continue
 
-            if remove_after_seconds is not None \
-                    and _gt(remove_after_seconds):
-                logs_toremove.add(log_file)
+        limits = node_capacity.get("limits")
+        allocated = node_capacity.get("allocated")
+
+        free[host] = {}
+
+        for resource in ("memory", "storage"):
+            limit = limits.get(resource)
+
+            if limit is None:
                 continue
 
-            if remove_after_weeks is not None \
-                    and _gt(remove_after_weeks):
-                logs_toremove.add(log_file)
+            free[host][resource] = (limit - allocated.get(resource, 0), limit)
+
+    plan = {}
+
+    # Place the virtual machines one by one, as if each one were already
+    # allocated when placing the next one.
+    for _ in range(count):
+        selected = None
+        selected_score = None
+
+        for host, host_free in free.items():
+            left = []
+
+            for resource, (resource_free, limit) in host_free.items():
+                left.append((resource_free - resources[resource]) / limit)
+
+            if left and min(left) <= 0:
                 continue
 
-    for log_toremove in logs_toremove:
-        info("Removing log '%s'" % log_toremove)
+            headroom = min(left) if left else 1.0
 
-        try:
-            os.remove(
-                os.path.join(logdir, log_toremove)
-            )
-        except Exception as e:
-            warn("Error removing log '%s': %s" % (log_toremove, e))
+            if algo == "least-loaded":
+                score = headroom
+            else:
+                score = -headroom
 
-    log = os.path.join(
-        logdir, time.strftime("%s.json")
-    )
+            if selected_score is None or score > selected_score:
+                selected = host
+                selected_score = score
 
-    info("Creating log file: %s" % log)
+        if selected is None:
+            break
 
-    with open(log, "w") as fd:
-        fd.write(message)
+        for resource, (resource_free, limit) in free[selected].items():
+            free[selected][resource] = (resource_free - resources[resource], limit)
 
-    client.delete(job)
+        plan[selected] = plan.get(selected, 0) + 1
 
-    client.close()
+    for host, host_count in plan.items():
+        info("plan:%s = %s:%d (%d)" % (algo, host[0], host[1], host_count))
 
-    return EX_OK
+    return plan
 
-def cmd_worker(argv, config):
+def cmd_logs(argv, config):
     parser = argparse.ArgumentParser(
         prog=argv[0],
-        description="Create a job for virtual machine creation"
+        description="Display the logs"
     )
 
-    parser.add_argument("--tube",
-        help="Stay in this tube for operations",
-        choices=("create", "destroy", "forward"),
-        required=True
+    parser.add_argument("--batch",
+        help="Display the summary of a batch created by 'create --count'"
+    )
+    parser.add_argument("--node",
+        help="Only the logs of this node"
+    )
+    parser.add_argument("--context",
+        help="Only the logs of this context (e.g. 'create', 'create.progress', 'destroy' or 'metrics')"
+    )
+    parser.add_argument("--since",
+        help="Only the logs newer than this timespan (e.g. '1h')"
+    )
+    parser.add_argument("--limit",
+        help="Display at most this number of logs",
+        type=int
+    )
+    parser.add_argument("--reverse",
+        help="Display the newest logs first",
+        action="store_true"
     )
 
     args = parser.parse_args(argv[1:])
 
-    tube = args.tube
+    batch_id = args.batch
 
-    local = config.get("local")
+    since = args.since
 
-    (host, port) = parse_host(local)
+    if since is not None:
+        since = time.time() - parse_timespan(since)
+
+    logs = logstore.query(LOGDIR,
+        since=since,
+        node=args.node,
+        context=args.context,
+        limit=args.limit,
+        reverse=args.reverse
+    )
 
-    (job, message, client) = watch(tube, host, port)
+    if batch_id is not None:
+        print(json.dumps(summarize_batch(batch_id, logs), indent=4))
 
-    if tube == "create":
-        return cmd_worker_create(job, message, client, config)
-    elif tube == "destroy":
-        return cmd_worker_destroy(job, message, client, config)
-    elif tube == "forward":
-        return cmd_worker_forward(job, message, client, config)
-    else:
         return EX_OK
 
-def cmd_worker_create(job, message, client, config):
-    reporter = config.get("reporter")
-    (reporter_host, reporter_port) = parse_host(reporter)
-    
-    if not check_limits(config.get("limits")) or \
-            not check_overload(config.get("overload")):
-        warn("Limits has been reached!")
+    # One log per line, as they are read.
+    for (log_time, seq, message) in logs:
+        print(json.dumps({
+            "time" : log_time,
+            "seq" : seq,
+            "message" : message
+        }), flush=True)
 
-        forward = config.get("forward")
+    return EX_OK
 
-        forward_next = forward.get("next")
+def cmd_timings(argv, config):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Display a summary of the time spent in each phase of the virtual machine creation"
+    )
 
-        if forward_next is not None:
-            (host, port) = parse_host(forward_next)
+    parser.add_argument("--node",
+        help="Only the virtual machines created by this node"
+    )
+    parser.add_argument("--batch",
+        help="Only the virtual machines of a batch created by 'create --count'"
+    )
 
-            status = "Forwarding message to %s:%d" % (host, port)
+    args = parser.parse_args(argv[1:])
 
-            warn(status)
+    node_id = args.node
+    batch_id = args.batch
 
-            forward_max = forward.get("max")
+    phases = {}
 
-            forward_message = {
-                "max" : forward_max - 1,
-                "message" : message
-            }
+    for (_, _, log) in logstore.query(LOGDIR, node=node_id, context="create"):
+        if log.get("context") != "create" or not log.get("timings"):
+            continue
 
-            try:
-                put(forward_message, "forward", host, port, config)
-            except Exception as e:
-                status = "Exception while forwarding message to %s:%d: %s" % (host, port, e)
+        batch = log.get("batch")
 
-                warn(status)
-        else:
-            status = "Could not forward the message because no node has been set!"
+        if batch_id is not None and (batch is None or batch.get("id") != batch_id):
+            continue
 
-            warn(status)
+        for timing in log["timings"]:
+            phase = phases.setdefault(timing["phase"], {
+                "durations" : [],
+                "bytes" : 0,
+                "nodes" : {}
+            })
 
-        client.delete(job)
+            phase["durations"].append(timing["duration"])
 
-        client.close()
+            if timing.get("bytes") is not None:
+                phase["bytes"] += timing["bytes"]
 
-        info("Reporting status")
+            node = phase["nodes"].setdefault(log.get("node-id"), [])
+            node.append(timing["duration"])
 
-        message = {
-            "node-id" : config.get("node-id"),
-            "forwarded" : forward_next,
-            "status" : status,
-            "context" : "create.forward"
+    summary = {}
+
+    for name, phase in phases.items():
+        summary[name] = summarize_durations(phase["durations"])
+        summary[name]["bytes"] = phase["bytes"]
+        summary[name]["nodes"] = {
+            node : summarize_durations(durations) for node, durations in phase["nodes"].items()
         }
 
-        put(message, "status", reporter_host, reporter_port, config)
+    print(json.dumps(summary, indent=4))
 
-        return EX_OK
+    return EX_OK
 
-    profile = message.get("profile")
-    
-    options = message.get("options")
+def summarize_durations(durations):
+    return {
+        "count" : len(durations),
+        "total" : sum(durations),
+        "mean" : statistics.mean(durations),
+        "median" : statistics.median(durations),
+        "max" : max(durations)
+    }
 
-    tags = message.get("tags")
+def summarize_batch(batch_id, logs):
+    summary = {
+        "batch" : batch_id,
+        "count" : None,
+        "created" : 0,
+        "failed" : 0,
+        "forwarded" : 0,
+        "nodes" : {},
+        "logs" : []
+    }
 
-    scripts = config.get("scripts")
+    for (log_time, seq, log) in logs:
+        batch = log.get("batch")
 
-    args = [
-        os.path.join(scripts, "timeout.sh"),
-        "%d" % (config.get("ttr") - 2),
-        os.path.join(scripts, "safe-deploy.sh"),
-        profile,
-        "tags=%s" % " ".join(tags)
-    ]
+        if batch is None or batch.get("id") != batch_id:
+            continue
 
-    if options is not None:
-        args.extend(options)
+        summary["count"] = batch.get("count")
+        summary["logs"].append({
+            "time" : log_time,
+            "seq" : seq,
+            "message" : log
+        })
 
-    info("Creating a new virtual machine")
+        # The progress is in the logs, but it is not a result.
+        if log.get("context") == "create.progress":
+            continue
 
-    process = subprocess.run(args,
-        stderr=subprocess.STDOUT,
-        stdout=subprocess.PIPE,
-        text=True
+        node_id = log.get("node-id")
+
+        node = summary["nodes"].setdefault(node_id, {
+            "created" : 0,
+            "failed" : 0,
+            "forwarded" : 0
+        })
+
+        if log.get("context") == "create.forward":
+            result = "forwarded"
+        elif log.get("status") == 0:
+            result = "created"
+        else:
+            result = "failed"
+
+        summary[result] += 1
+        node[result] += 1
+
+    return summary
+
+def cmd_status(argv, config):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Store the status messages sent by the nodes"
     )
 
-    client.delete(job)
+    parser.add_argument("--persistent",
+        help="Keep reserving jobs instead of exiting after the first batch",
+        action="store_true"
+    )
+    parser.add_argument("--batch-size",
+        help="Maximum number of jobs stored at once (default: %(default)s)",
+        type=int,
+        default=DEFAULT_STATUS_BATCH_SIZE
+    )
+    parser.add_argument("--max-jobs",
+        help="Recycle the collector after storing this number of jobs (persistent mode)",
+        type=int
+    )
+    parser.add_argument("--max-lifetime",
+        help="Recycle the collector after this amount of time (persistent mode)"
+    )
 
-    client.close()
+    args = parser.parse_args(argv[1:])
 
-    message = {
-        "node-id" : config.get("node-id"),
-        "status" : process.returncode,
-        "output" : process.stdout,
-        "tags" : tags,
-        "context" : "create"
-    }
+    persistent = args.persistent
+    batch_size = args.batch_size
 
-    info("Reporting status")
+    if batch_size < 1:
+        err("Batch size must be greater than or equal to 1!")
+        return EX_USAGE
 
-    put(message, "status", reporter_host, reporter_port, config)
+    worker_config = config.get("worker")
 
-    return EX_OK
+    max_jobs = args.max_jobs
 
-def cmd_worker_destroy(job, message, client, config):
-    tags = message.get("tags")
+    if max_jobs is None:
+        max_jobs = worker_config.get("max-jobs")
 
-    scripts = config.get("scripts")
+    max_lifetime = args.max_lifetime
+
+    if max_lifetime is None:
+        max_lifetime = worker_config.get("max-lifetime")
+    else:
+        max_lifetime = parse_timespan(max_lifetime)
+
+    if persistent:
+        handle_signals()
 
     reporter = config.get("reporter")
     (host, port) = parse_host(reporter)
 
-    ttr = config.get("ttr")
-    ttr //= 2
+    if not os.path.isdir(LOGDIR):
+        os.makedirs(LOGDIR, exist_ok=True)
 
-    args = [
-        os.path.join(scripts, "timeout.sh"),
-        "%d" % (ttr - 2),
-        os.path.join(scripts, "find.sh")
-    ]
+    (segment_size, _, _) = get_logs_retention(config)
 
-    args.extend(tags)
+    if logstore.migrate(LOGDIR, segment_size) > 0:
+        info("Log files have been moved to the log store")
 
-    info("Finding virtual machines")
+    client = connect(host, port)
 
-    process = subprocess.run(args, capture_output=True, text=True)
+    info("Watching (tube:status)")
 
-    vms = process.stdout.splitlines()
+    client.watch("status")
 
-    result = {}
+    started = time.time()
+    stored = 0
 
-    if process.returncode == 0 and len(vms) > 0:
-        for vm in vms:
-            warn("Destroying virtual machine (vm:%s)" % vm)
-
-            args = [
-                os.path.join(scripts, "timeout.sh"),
-                "%d" % (ttr - 2),
-                os.path.join(scripts, "destroy.sh"),
-                vm
-            ]
-
-            process = subprocess.run(args,
-                          capture_output=True,
-                          text=True
-                      )
-
-            rc = process.returncode
-            stdout = process.stdout
-            stderr = process.stderr
-
-            result[vm] = {
-                "status" : rc,
-                "stdout" : stdout,
-                "stderr" : stderr
-            }
-    else:
-        rc = process.returncode
-        stdout = process.stdout
-        stderr = process.stderr
+    while not WORKER_STOP:
+        if not persistent:
+            timeout = None
+        else:
+            timeout = DEFAULT_WORKER_POLL
 
-        result["<not-found>"] = {
-            "status" : rc,
-            "stdout" : stdout,
-            "stderr" : stderr
-        }
+            if max_jobs > 0 and stored >= max_jobs:
+                info("Maximum number of jobs reached (%d)" % max_jobs)
+                break
 
-        warn("No virtual machines to destroy found.")
+            if max_lifetime > 0:
+                remaining = max_lifetime - (time.time() - started)
 
-    client.delete(job)
+                if remaining <= 0:
+                    info("Maximum lifetime reached (%d)" % max_lifetime)
+                    break
 
-    client.close()
+                timeout = min(timeout, max(1, int(remaining)))
 
-    message = {
-        "node-id" : config.get("node-id"),
-        "context" : "destroy",
-        "destroyed" : result
-    }
+        jobs = reserve_batch(client, batch_size, timeout)
 
-    info("Reporting status")
+        if jobs:
+            stored += store_status(jobs, client, config)
 
-    put(message, "status", host, port, config)
+        if not persistent:
+            break
+
+    client.close()
 
     return EX_OK
 
-def cmd_worker_forward(job, message, client, config):
-    forward_message = message
+# Blocks until a job is ready and takes the ones that are also ready. The jobs
+# are decoded by store_status(), so an invalid job does not stop the collector.
+def reserve_batch(client, batch_size, timeout):
+    jobs = []
 
-    forward_max = forward_message.get("max")
+    try:
+        jobs.append(client.reserve(timeout=timeout))
 
-    if forward_max <= 0:
-        warn("Maximum number of forwarding reached!")
+        while len(jobs) < batch_size:
+            jobs.append(client.reserve(timeout=0))
+    except (greenstalk.TimedOutError, greenstalk.DeadlineSoonError):
+        pass
 
-        return EX_OK
+    for job in jobs:
+        info("Reserved (job:%d)" % job.id)
 
-    message = forward_message.get("message")
+    return jobs
 
-    return cmd_worker_create(job, message, client, config)
+# The jobs are deleted only after the logs have been written to disk, all of
+# them at once, so they are not lost if the collector dies.
+def store_status(jobs, client, config):
+    (segment_size, segment_records, retention) = get_logs_retention(config)
 
-def cmd_destroy(argv, config):
-    parser = argparse.ArgumentParser(
-        prog=argv[0],
-        description="Create a job for virtual machine destruction"
-    )
+    records = []
 
-    parser.add_argument("--target",
-        help="Destroy virtual machines in this host"
-    )
-    parser.add_argument("--tags",
-        help="Destroy virtual machines that match with these tags",
-        required=True
-    )
+    now = time.time()
 
-    args = parser.parse_args(argv[1:])
+    for job in jobs:
+        try:
+            message = json.loads(decode(job.body))
+        except (zlib.error, ValueError) as e:
+            warn("Invalid status message (job:%d): %s" % (job.id, e))
 
-    target = args.target
-    tags = args.tags
+            message = {
+                "context" : "invalid",
+                "message" : job.body.decode(errors="replace")
+            }
 
-    tags = tags.split()
+        if not isinstance(message, dict):
+            warn("Invalid status message (job:%d): not an object" % job.id)
 
-    message = {
-        "tags" : tags
-    }
+            message = {
+                "context" : "invalid",
+                "message" : message
+            }
 
-    if target is None:
-        targets = config.get("hosts")
-    else:
-        targets = [parse_host(target)]
+        records.append((now, message))
 
-    for target in targets:
-        (host, port) = target
+    try:
+        (seqs, removed) = logstore.append(LOGDIR, records,
+            segment_size, segment_records, retention
+        )
+    except Exception as e:
+        warn("Exception while storing %d logs: %s" % (len(jobs), e))
 
-        try:
-            put(message, "destroy", host, port, config)
-        except Exception as e:
-            warn("Exception: %s" % e)
+        # Try again later.
+        for job in jobs:
+            client.release(job, delay=DEFAULT_WORKER_POLL)
 
-    return EX_OK
+        return 0
 
-def cmd_metrics(argv, config):
-    metrics_config = config.get("metrics")
+    info("%d logs have been stored (seq:%d-%d)" % (len(seqs), seqs[0], seqs[-1]))
 
-    delay = metrics_config.get("delay")
-    skew = metrics_config.get("skew")
+    for segment in removed:
+        info("Removed log segment '%s'" % segment["name"])
 
-    if delay > 0:
-        info("Sleeping %d seconds (delay)" % delay)
+    for job in jobs:
+        client.delete(job)
 
-        time.sleep(delay)
+    for (log_time, message) in records:
+        if message.get("context") != "metrics" or message.get("status") != EX_OK:
+            continue
 
-    if skew > 0:
-        skew = random.randint(1, skew)
+        node_id = message.get("node-id")
 
-        info("Sleeping %d seconds (skew)" % skew)
+        # The logs have already been stored.
+        try:
+            metrics = series.restore(SERIESDIR, node_id, message.get("seq"), message.get("base"), message.get("stdout"))
 
-        time.sleep(skew)
+            if metrics is None:
+                warn("Metrics of '%s' (seq:%d) are a delta against a report that has not been received, waiting for a full snapshot" % (node_id, message["seq"]))
+                continue
 
-    reporter = config.get("reporter")
-    (host, port) = parse_host(reporter)
+            series.record(SERIESDIR, node_id, log_time, metrics, config.get("series"))
+        except Exception as e:
+            warn("Exception while recording the metrics of '%s': %s" % (node_id, e))
 
-    info("Retrieving metrics")
+    return len(jobs)
 
-    prog = os.path.join(BASEDIR, "../get-metrics.py")
+# Logs are removed a segment at a time, so the segments are kept small
+# compared to 'logs.remove-count' and 'logs.max-bytes'.
+def get_logs_retention(config):
+    logs = config.get("logs")
 
-    process = subprocess.run([prog],
-                  capture_output=True,
-                  text=True
-              )
+    remove_after = logs.get("remove-after")
+    remove_count = logs.get("remove-count")
+    max_bytes = logs.get("max-bytes")
 
-    if process.stdout == "":
-        metrics = {}
+    segment_size = logs.get("segment-size")
+    segment_records = None
+
+    if remove_count is not None:
+        segment_records = max(1, remove_count // DEFAULT_LOGS_SEGMENTS)
+
+    if max_bytes is not None:
+        segment_size = min(segment_size, max(1, max_bytes // DEFAULT_LOGS_SEGMENTS))
+
+    # A log is removed when any of the durations is exceeded.
+    max_age = [age for age in remove_after.values() if age is not None]
+
+    if max_age:
+        max_age = min(max_age)
     else:
-        metrics = json.loads(process.stdout)
+        max_age = None
 
-    message = {
-        "node-id" : config.get("node-id"),
-        "context" : "metrics",
+    retention = {
+        "max-age" : max_age,
+        "max-count" : remove_count,
+        "max-bytes" : max_bytes
+    }
+
+    return (segment_size, segment_records, retention)
+
+def cmd_worker(argv, config):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Create a job for virtual machine creation"
+    )
+
+    parser.add_argument("--tube",
+        help="Stay in this tube for operations",
+        choices=("create", "destroy", "forward"),
+        required=True
+    )
+    parser.add_argument("--persistent",
+        help="Keep reserving jobs instead of exiting after the first one",
+        action="store_true"
+    )
+    parser.add_argument("--max-jobs",
+        help="Recycle the worker after processing this number of jobs (persistent mode)",
+        type=int
+    )
+    parser.add_argument("--max-lifetime",
+        help="Recycle the worker after this amount of time (persistent mode)"
+    )
+    parser.add_argument("--concurrency",
+        help="Number of virtual machines to create in parallel (create tube)",
+        type=int
+    )
+
+    args = parser.parse_args(argv[1:])
+
+    tube = args.tube
+    persistent = args.persistent
+
+    worker_config = config.get("worker")
+
+    max_jobs = args.max_jobs
+
+    if max_jobs is None:
+        max_jobs = worker_config.get("max-jobs")
+
+    max_lifetime = args.max_lifetime
+
+    if max_lifetime is None:
+        max_lifetime = worker_config.get("max-lifetime")
+    else:
+        max_lifetime = parse_timespan(max_lifetime)
+
+    concurrency = args.concurrency
+
+    if concurrency is None:
+        concurrency = worker_config.get("concurrency")
+
+    if concurrency < 1:
+        err("Concurrency must be greater than or equal to 1!")
+        return EX_USAGE
+
+    if tube != "create":
+        concurrency = 1
+
+    if not persistent:
+        max_jobs = concurrency
+        max_lifetime = 0
+    else:
+        handle_signals()
+
+    local = config.get("local")
+
+    (host, port) = parse_host(local)
+
+    client = connect(host, port)
+
+    info("Watching (tube:%s)" % tube)
+
+    client.watch(tube)
+
+    if concurrency > 1:
+        rc = cmd_worker_pool(client, config, concurrency, persistent, max_jobs, max_lifetime)
+
+        client.close()
+
+        return rc
+
+    started = time.time()
+    processed = 0
+
+    while not WORKER_STOP:
+        if max_jobs > 0 and processed >= max_jobs:
+            if persistent:
+                info("Maximum number of jobs reached (%d)" % max_jobs)
+
+            break
+
+        if not persistent:
+            timeout = None
+        else:
+            timeout = DEFAULT_WORKER_POLL
+
+        if max_lifetime > 0:
+            remaining = max_lifetime - (time.time() - started)
+
+            if remaining <= 0:
+                info("Maximum lifetime reached (%d)" % max_lifetime)
+                break
+
+            timeout = min(timeout, max(1, int(remaining)))
+
+        try:
+            (job, message) = reserve(client, timeout=timeout)
+        except (greenstalk.TimedOutError, greenstalk.DeadlineSoonError):
+            continue
+        except InvalidJob:
+            processed += 1
+            continue
+
+        processed += 1
+
+        try:
+            if tube == "create":
+                cmd_worker_create(job, message, client, config)
+            elif tube == "destroy":
+                cmd_worker_destroy(job, message, client, config)
+            elif tube == "forward":
+                cmd_worker_forward(job, message, client, config)
+        except Exception as e:
+            err("Exception while processing the job (job:%d): %s" % (job.id, e))
+
+            # Otherwise it would be reserved again after its TTR and fail
+            # the same way.
+            if not bury(client, job):
+                break
+
+    client.close()
+
+    return EX_OK
+
+def cmd_worker_create(job, message, client, config, forwarded=None):
+    reporter = config.get("reporter")
+    (reporter_host, reporter_port) = parse_host(reporter)
+
+    if not admit(message.get("profile"), config):
+        message = forward_job(message, config, forwarded)
+    else:
+        message = deploy(message, config)
+
+    client.delete(job)
+
+    info("Reporting status")
+
+    put(message, "status", reporter_host, reporter_port, config)
+
+    return EX_OK
+
+def cmd_worker_pool(client, config, concurrency, persistent, max_jobs, max_lifetime):
+    reporter = config.get("reporter")
+    (reporter_host, reporter_port) = parse_host(reporter)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    # future -> (job, resources, batch, profile)
+    running = {}
+
+    started = time.time()
+    processed = 0
+    accepting = True
+
+    while True:
+        for future in [f for f in running if f.done()]:
+            (job, _, batch, _) = running.pop(future)
+
+            try:
+                message = future.result()
+            except Exception as e:
+                warn("Exception while deploying (job:%d): %s" % (job.id, e))
+
+                message = {
+                    "node-id" : config.get("node-id"),
+                    "status" : EX_SOFTWARE,
+                    "output" : "%s" % e,
+                    "batch" : batch,
+                    "context" : "create"
+                }
+
+            client.delete(job)
+
+            info("Reporting status (job:%d)" % job.id)
+
+            put(message, "status", reporter_host, reporter_port, config)
+
+        if WORKER_STOP:
+            accepting = False
+        elif max_jobs > 0 and processed >= max_jobs:
+            accepting = False
+        elif max_lifetime > 0 and (time.time() - started) >= max_lifetime:
+            accepting = False
+
+        if not accepting or len(running) >= concurrency:
+            if not running:
+                break
+
+            concurrent.futures.wait(running,
+                timeout=DEFAULT_WORKER_POLL,
+                return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            continue
+
+        if running:
+            # Don't block: there are deployments to report.
+            timeout = 1
+        elif persistent:
+            timeout = DEFAULT_WORKER_POLL
+        else:
+            timeout = None
+
+        try:
+            (job, message) = reserve(client, timeout=timeout)
+        except (greenstalk.TimedOutError, greenstalk.DeadlineSoonError):
+            if not persistent:
+                # In one-shot mode only take the jobs that are ready.
+                accepting = False
+
+            continue
+        except InvalidJob:
+            continue
+
+        processed += 1
+
+        reserved = {
+            "memory" : 0,
+            "storage" : 0
+        }
+
+        profile = message.get("profile")
+
+        # The deployments of the same profile may still claim a pooled VM.
+        claims = 0
+
+        for (_, resources, _, running_profile) in running.values():
+            reserved["memory"] += resources["memory"]
+            reserved["storage"] += resources["storage"]
+
+            if running_profile == profile:
+                claims += 1
+
+        if not admit(profile, config, reserved, claims):
+            message = forward_job(message, config)
+
+            client.delete(job)
+
+            info("Reporting status (job:%d)" % job.id)
+
+            put(message, "status", reporter_host, reporter_port, config)
+
+            continue
+
+        resources = get_profile_resources(profile, config)
+
+        future = executor.submit(deploy, message, config, lock=False)
+
+        running[future] = (job, resources, message.get("batch"), profile)
+
+    executor.shutdown()
+
+    return EX_OK
+
+def forward_job(message, config, forwarded=None):
+    warn("Limits has been reached!")
+
+    forward = config.get("forward")
+
+    node_id = config.get("node-id")
+
+    if forwarded is None:
+        forward_max = forward.get("max")
+        visited = []
+        forwarded_to = []
+    else:
+        forward_max = forwarded.get("max")
+        visited = forwarded.get("visited", [])
+        forwarded_to = forwarded.get("forwarded-to", [])
+
+    if node_id not in visited:
+        visited = visited + [node_id]
+
+    candidates = get_forward_candidates(visited, forwarded_to, config)
+
+    forward_next = None
+
+    if not forward.get("next"):
+        status = "Could not forward the message because no node has been set!"
+
+        warn(status)
+    elif not candidates:
+        status = "Could not forward the message because all nodes have been visited!"
+
+        warn(status)
+    else:
+        status = None
+
+        for (host, port) in order_forward_candidates(candidates, message, config):
+            forward_next = "%s:%d" % (host, port)
+
+            warn("Forwarding message to %s" % forward_next)
+
+            forward_message = {
+                "max" : forward_max - 1,
+                "visited" : visited,
+                "forwarded-to" : forwarded_to + [forward_next],
+                "message" : message
+            }
+
+            try:
+                put(forward_message, "forward", host, port, config)
+            except Exception as e:
+                status = "Exception while forwarding message to %s: %s" % (forward_next, e)
+
+                warn(status)
+
+                forward_next = None
+
+                continue
+
+            status = "Forwarding message to %s" % forward_next
+
+            break
+
+    return {
+        "node-id" : node_id,
+        "forwarded" : forward_next,
+        "status" : status,
+        "batch" : message.get("batch"),
+        "context" : "create.forward"
+    }
+
+def get_forward_candidates(visited, forwarded_to, config):
+    nodes = config.get("nodes")
+
+    hosts_nodes = { host : node for node, host in nodes.items() }
+
+    candidates = []
+
+    for host in config.get("forward").get("next"):
+        if "%s:%d" % host in forwarded_to:
+            continue
+
+        if hosts_nodes.get(host) in visited:
+            continue
+
+        candidates.append(host)
+
+    return candidates
+
+def order_forward_candidates(candidates, message, config):
+    global FORWARD_INDEX
+
+    policy = config.get("forward").get("policy")
+
+    if len(candidates) == 1:
+        return candidates
+
+    # The metrics of the nodes are in the log store of the reporter, so they
+    # are not available when this node is not the reporter.
+    if policy == "capacity" and not get_nodes_capacity(config):
+        warn("No node has reported its capacity here (is this the reporter?), using 'round-robin'")
+
+        policy = "round-robin"
+
+    if policy == "round-robin":
+        index = FORWARD_INDEX % len(candidates)
+
+        FORWARD_INDEX += 1
+
+        return candidates[index:] + candidates[:index]
+
+    if policy == "capacity":
+        selected = select_by_capacity(candidates, "least-loaded", message.get("profile"), config)
+    else:
+        selected = select_less_latency(candidates, config)
+
+    if selected is None:
+        return candidates
+
+    return [selected] + [host for host in candidates if host != selected]
+
+def deploy(message, config, lock=True):
+    profile = message.get("profile")
+    
+    options = message.get("options")
+
+    tags = message.get("tags")
+
+    scripts = config.get("scripts")
+
+    # deploy.sh allocates the VM name atomically, so the global lock
+    # of safe-deploy.sh is only needed to preserve the one-VM-at-a-time
+    # behavior.
+    if lock:
+        deploy_script = "safe-deploy.sh"
+    else:
+        deploy_script = "deploy.sh"
+
+    args = [
+        os.path.join(scripts, "timeout.sh"),
+        "%d" % (config.get("ttr") - 2),
+        os.path.join(scripts, deploy_script),
+        profile,
+        "tags=%s" % " ".join(tags)
+    ]
+
+    if options is not None:
+        args.extend(options)
+
+    info("Creating a new virtual machine")
+
+    started = time.time()
+
+    # Only the last lines are kept, the build may be very verbose.
+    output = collections.deque(maxlen=config.get("worker").get("output-lines"))
+    omitted = 0
+
+    vm = None
+
+    with subprocess.Popen(args,
+        stderr=subprocess.STDOUT,
+        stdout=subprocess.PIPE,
+        text=True
+    ) as process:
+        for line in process.stdout:
+            if len(output) == output.maxlen:
+                omitted += 1
+
+            output.append(line)
+
+            phase = get_progress_phase(line)
+
+            if phase is None:
+                continue
+
+            report_progress(*phase, started, message, config)
+
+            match = re.search(r"VM '(vm[0-9]+)'", phase[1])
+
+            if match:
+                vm = match.group(1)
+
+    output = "".join(output)
+
+    if omitted > 0:
+        output = "... (%d lines omitted)\n%s" % (omitted, output)
+
+    return {
+        "node-id" : config.get("node-id"),
         "status" : process.returncode,
+        "output" : output,
+        "elapsed" : time.time() - started,
+        "vm" : vm,
+        "timings" : get_vm_timings(vm),
+        "tags" : tags,
+        "batch" : message.get("batch"),
+        "context" : "create"
+    }
+
+# Phases recorded by create.sh and deploy.sh. See timing_begin() in lib.subr.
+def get_vm_timings(vm):
+    if vm is None:
+        return None
+
+    vm_bhyve_dir = collector.get_vm_dir()
+
+    if vm_bhyve_dir is None:
+        return None
+
+    timings_file = os.path.join(vm_bhyve_dir, vm, ".timings")
+
+    timings = []
+
+    try:
+        with open(timings_file) as fd:
+            for line in fd:
+                timings.append(json.loads(line))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        warn("Error reading timings '%s': %s" % (timings_file, e))
+        return None
+
+    return timings
+
+def get_progress_phase(line):
+    match = re.search(r"^===> (.+) <===$", line.rstrip("\n"))
+
+    if not match:
+        return None
+
+    banner = match.group(1)
+
+    for (prefix, phase) in PROGRESS_PHASES:
+        if banner.startswith(prefix):
+            return (phase, banner)
+
+    return None
+
+def report_progress(phase, banner, started, message, config):
+    reporter = config.get("reporter")
+    (reporter_host, reporter_port) = parse_host(reporter)
+
+    now = time.time()
+
+    progress = {
+        "node-id" : config.get("node-id"),
+        "phase" : phase,
+        "banner" : banner,
+        "time" : now,
+        "elapsed" : now - started,
+        "tags" : message.get("tags"),
+        "batch" : message.get("batch"),
+        "context" : "create.progress"
+    }
+
+    # A lost progress report must not interrupt the build.
+    try:
+        put(progress, "status", reporter_host, reporter_port, config)
+    except Exception as e:
+        warn("Exception while reporting progress (phase:%s): %s" % (phase, e))
+
+def cmd_pool(argv, config):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Keep a pool of pre-built virtual machines for each profile"
+    )
+
+    parser.add_argument("--once",
+        help="Refill the pools once and exit",
+        action="store_true"
+    )
+
+    args = parser.parse_args(argv[1:])
+
+    once = args.once
+
+    pool = config.get("pool")
+
+    if not pool.get("profiles"):
+        info("No pool has been defined")
+        return EX_OK
+
+    handle_signals()
+
+    delay = pool.get("delay")
+
+    while not WORKER_STOP:
+        refilled = refill_pool(config)
+
+        if once and not refilled:
+            break
+
+        if refilled:
+            continue
+
+        # Wake up from time to time to honor SIGTERM.
+        waited = 0
+
+        while not WORKER_STOP and waited < delay:
+            time.sleep(1)
+
+            waited += 1
+
+    return EX_OK
+
+def refill_pool(config):
+    pool = config.get("pool")
+
+    for profile, size in pool.get("profiles").items():
+        if WORKER_STOP:
+            return False
+
+        pooled = len(get_pooled_vms(profile, config))
+
+        if pooled >= size:
+            continue
+
+        info("Pool '%s' has %d of %d virtual machines" % (profile, pooled, size))
+
+        resources = get_profile_resources(profile, config)
+
+        if not check_capacity(config, resources):
+            warn("Limits has been reached, pool '%s' will not be refilled" % profile)
+            continue
+
+        scripts = config.get("scripts")
+
+        args = [
+            os.path.join(scripts, "timeout.sh"),
+            "%d" % (config.get("ttr") - 2),
+            os.path.join(scripts, "deploy.sh"),
+            "-p",
+            profile
+        ]
+
+        info("Creating a new virtual machine for the pool '%s'" % profile)
+
+        process = subprocess.run(args,
+            stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE,
+            text=True
+        )
+
+        if process.returncode != 0:
+            warn("Could not create a virtual machine for the pool '%s' (status:%d): %s" % (profile, process.returncode, process.stdout))
+            continue
+
+        return True
+
+    return False
+
+# A pooled VM is already counted in the limits, but not in the overload because
+# it has not been started yet. deploy.sh claims a pooled VM only when it runs,
+# so the limits are skipped only while there are more pooled VMs than 'claims'
+# (the deployments of the profile in progress).
+def admit(profile, config, reserved=None, claims=0):
+    pooled = len(get_pooled_vms(profile, config)) > claims
+
+    return check_capacity(config, reserved, pooled)
+
+def get_pooled_vms(profile, config):
+    pool_dir = os.path.join(config.get("scripts"), "pool", profile)
+
+    try:
+        return sorted(os.listdir(pool_dir))
+    except FileNotFoundError:
+        return []
+
+def cmd_worker_destroy(job, message, client, config):
+    tags = message.get("tags")
+
+    scripts = config.get("scripts")
+
+    reporter = config.get("reporter")
+    (host, port) = parse_host(reporter)
+
+    ttr = config.get("ttr")
+    ttr //= 2
+
+    exact = message.get("exact", False)
+
+    info("Finding virtual machines")
+
+    try:
+        vms = tagindex.find(tags, exact)
+
+        find_status = EX_OK
+        find_stderr = ""
+    except Exception as e:
+        vms = []
+
+        find_status = EX_SOFTWARE
+        find_stderr = "%s" % e
+
+    result = {}
+
+    if len(vms) > 0:
+        destroy_config = config.get("destroy")
+
+        concurrency = destroy_config.get("concurrency")
+        io_concurrency = destroy_config.get("io-concurrency")
+
+        timeout = destroy_config.get("timeout")
+
+        if timeout is None:
+            timeout = ttr - 2
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {}
+
+            for nro, vm in enumerate(vms):
+                # destroy.sh takes this lock while removing the VM files, so
+                # only 'io-concurrency' VMs are removed at the same time.
+                io_lock = os.path.join(scripts, ".destroy.%d.lock" % (nro % io_concurrency))
+
+                future = executor.submit(destroy_vm, vm, timeout, io_lock, config)
+
+                futures[future] = vm
+
+            for future in concurrent.futures.as_completed(futures):
+                vm = futures[future]
+
+                try:
+                    result[vm] = future.result()
+                except Exception as e:
+                    result[vm] = {
+                        "status" : EX_SOFTWARE,
+                        "stdout" : "",
+                        "stderr" : "%s" % e
+                    }
+
+                info("Reporting status (vm:%s)" % vm)
+
+                message = {
+                    "node-id" : config.get("node-id"),
+                    "context" : "destroy.vm",
+                    "vm" : vm,
+                    "destroyed" : result[vm]
+                }
+
+                try:
+                    put(message, "status", host, port, config)
+                except Exception as e:
+                    warn("Exception while reporting status (vm:%s): %s" % (vm, e))
+    else:
+        result["<not-found>"] = {
+            "status" : find_status,
+            "stdout" : "",
+            "stderr" : find_stderr
+        }
+
+        warn("No virtual machines to destroy found.")
+
+    client.delete(job)
+
+    message = {
+        "node-id" : config.get("node-id"),
+        "context" : "destroy",
+        "destroyed" : result
+    }
+
+    info("Reporting status")
+
+    put(message, "status", host, port, config)
+
+    return EX_OK
+
+def destroy_vm(vm, timeout, io_lock, config):
+    scripts = config.get("scripts")
+
+    warn("Destroying virtual machine (vm:%s)" % vm)
+
+    args = [
+        os.path.join(scripts, "timeout.sh"),
+        "%d" % timeout,
+        os.path.join(scripts, "destroy.sh"),
+        vm
+    ]
+
+    env = dict(os.environ)
+    env["DESTROY_LOCK"] = io_lock
+
+    process = subprocess.run(args,
+                  capture_output=True,
+                  text=True,
+                  env=env
+              )
+
+    return {
+        "status" : process.returncode,
+        "stdout" : process.stdout,
+        "stderr" : process.stderr
+    }
+
+def cmd_worker_forward(job, message, client, config):
+    forward_message = message
+
+    forward_max = forward_message.get("max")
+
+    if forward_max <= 0:
+        warn("Maximum number of forwarding reached!")
+
+        client.delete(job)
+
+        return EX_OK
+
+    message = forward_message.get("message")
+
+    return cmd_worker_create(job, message, client, config, forward_message)
+
+def cmd_destroy(argv, config):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Create a job for virtual machine destruction"
+    )
+
+    parser.add_argument("--target",
+        help="Destroy virtual machines in this host"
+    )
+    parser.add_argument("--tags",
+        help="Destroy virtual machines that match with these tags",
+        required=True
+    )
+    parser.add_argument("--exact",
+        help="Match the tags exactly instead of using them as regular expressions",
+        action="store_true"
+    )
+
+    args = parser.parse_args(argv[1:])
+
+    target = args.target
+    tags = args.tags
+    exact = args.exact
+
+    tags = tags.split()
+
+    message = {
+        "tags" : tags,
+        "exact" : exact
+    }
+
+    if target is None:
+        targets = config.get("hosts")
+    else:
+        targets = [parse_host(target)]
+
+    fan_out(lambda host, port: put(message, "destroy", host, port, config), targets)
+
+    return EX_OK
+
+def cmd_metrics(argv, config):
+    metrics_config = config.get("metrics")
+
+    delay = metrics_config.get("delay")
+    skew = metrics_config.get("skew")
+    full_every = metrics_config.get("full-every")
+
+    if delay > 0:
+        info("Sleeping %d seconds (delay)" % delay)
+
+        time.sleep(delay)
+
+    if skew > 0:
+        skew = random.randint(1, skew)
+
+        info("Sleeping %d seconds (skew)" % skew)
+
+        time.sleep(skew)
+
+    reporter = config.get("reporter")
+    (host, port) = parse_host(reporter)
+
+    info("Retrieving metrics")
+
+    status = EX_OK
+    stderr = ""
+
+    limits = config.get("limits")
+
+    window = config.get("capacity").get("window")
+
+    try:
+        metrics = collector.collect_metrics()
+
+        rates = collector.record_sample(metrics, window)
+
+        # Used by the 'least-loaded' and 'best-fit' algorithms.
+        capacity = {
+            "limits" : {
+                "memory" : limits.get("memory"),
+                "storage" : limits.get("storage")
+            },
+            "allocated" : ledger.get_total(limits.get("reconcile")).todict(),
+            "usage" : collector.total_metrics(metrics).todict(),
+            "rates" : None if rates is None else rates.todict()
+        }
+
+        metrics = { vm : vm_metrics.todict() for vm, vm_metrics in metrics.items() }
+    except Exception as e:
+        status = EX_SOFTWARE
+        stderr = "%s" % e
+        metrics = {}
+        capacity = None
+
+    message = {
+        "node-id" : config.get("node-id"),
+        "context" : "metrics",
+        "status" : status,
         "stdout" : metrics,
-        "stderr" : process.stderr
+        "stderr" : stderr,
+        "capacity" : capacity
     }
 
-    info("Reporting status")
+    if status != EX_OK:
+        info("Reporting status")
 
-    put(message, "status", host, port, config)
+        put(message, "status", host, port, config)
+
+        return EX_OK
+
+    # Most metrics do not change between reports, so only the changes are sent.
+    # The report is the base of the next one once it is in the reporter.
+    with state.lock(collector.REPORT_FILE):
+        report = collector.get_report(metrics, full_every)
+
+        message["stdout"] = report["metrics"]
+        message["seq"] = report["seq"]
+        message["base"] = report["base"]
+
+        if report["base"] is None:
+            info("Reporting status (seq:%d, full)" % report["seq"])
+        else:
+            info("Reporting status (seq:%d, base:%d)" % (report["seq"], report["base"]))
+
+        put(message, "status", host, port, config)
+
+        collector.save_report(report, metrics)
+
+    return EX_OK
+
+def cmd_health(argv, config):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Keep the latency and health of the hosts up to date"
+    )
+
+    parser.add_argument("--dump",
+        help="Display the health table and exit",
+        action="store_true"
+    )
+    parser.add_argument("--once",
+        help="Probe the hosts once and exit",
+        action="store_true"
+    )
+
+    args = parser.parse_args(argv[1:])
+
+    if args.dump:
+        print(json.dumps(health.load(), indent=4))
+        return EX_OK
+
+    once = args.once
+
+    hosts = config.get("hosts")
+
+    latency_config = config.get("latency")
+    health_config = config.get("health")
+
+    interval = health_config.get("interval")
+    alpha = health_config.get("alpha")
+
+    handle_signals()
+
+    while not WORKER_STOP:
+        info("Probing %d hosts" % len(hosts))
+
+        results = probe_latency(hosts, latency_config)
+
+        health.record(results, alpha)
+
+        if once:
+            break
+
+        # Wake up from time to time to honor SIGTERM.
+        waited = 0
+
+        while not WORKER_STOP and waited < interval:
+            time.sleep(1)
+
+            waited += 1
 
     return EX_OK
 
-def select_hosts(hosts, algo, arg):
+def select_hosts(hosts, algo, arg, config, profile=None):
     selected_hosts = []
 
     if algo == "all":
@@ -626,7 +1783,6 @@ def select_hosts(hosts, algo, arg):
 
         selected_hosts.append(host)
     elif algo == "less-latency":
-        less_latency = 0
         selected = None
 
         for host in hosts:
@@ -635,95 +1791,513 @@ def select_hosts(hosts, algo, arg):
                 selected = host
                 break
 
-            latencies = tcp_latency.measure_latency(host[0], host[1], runs=4)
+        if selected is None:
+            selected = select_less_latency(hosts, config)
 
-            if not latencies:
-                continue
+        host = selected
+
+        if host is None:
+            raise HostNotFound("Match not found!")
+
+        info("selection:%s = %s:%d" % (algo, host[0], host[1]))
+
+        selected_hosts.append(host)
+    elif algo == "least-loaded" or algo == "best-fit":
+        if profile is None:
+            profile = config.get("default-profile")
+
+        host = select_by_capacity(hosts, algo, profile, config)
+
+        if host is None:
+            warn("No host with enough capacity has been found, using 'less-latency'")
+
+            return select_hosts(hosts, "less-latency", arg, config, profile)
 
-            latency = statistics.mean(latencies)
+        info("selection:%s = %s:%d" % (algo, host[0], host[1]))
+
+        selected_hosts.append(host)
+    elif algo == "single":
+        if arg is None:
+            raise ArgumentRequired("'single' algorithm requires an argument!")
+
+        selected = None
 
-            if less_latency == 0 or latency < less_latency:
-                less_latency = latency
+        (selected_host, selected_port) = parse_host(arg)
+
+        for host in hosts:
+            if host[0] == selected_host and \
+                    host[1] == selected_port:
                 selected = host
+                break
 
         host = selected
 
-        if host is None:
-            raise HostNotFound("Match not found!")
+        if host is None:
+            raise HostNotFound(f"Match not found for host '{selected_host}:{selected_port}'")
+
+        info("selection:%s = %s:%d" % (algo, host[0], host[1]))
+
+        selected_hosts.append(host)
+    else:
+        raise InvalidAlgorithm(f"Invalid algorithm '{algo}'")
+
+    return selected_hosts
+
+def select_less_latency(hosts, config):
+    latency_config = config.get("latency")
+    health_config = config.get("health")
+
+    max_age = health_config.get("max-age")
+    max_failures = health_config.get("max-failures")
+
+    table = health.load()
+
+    latencies = {}
+    stale = []
+
+    for host in hosts:
+        entry = health.get(table, host, max_age)
+
+        if entry is None:
+            stale.append(host)
+        elif max_failures > 0 and entry["failures"] >= max_failures:
+            info("%s:%d is skipped (failures:%d)" % (host[0], host[1], entry["failures"]))
+        elif entry["latency"] is None:
+            stale.append(host)
+        else:
+            latencies[host] = entry["latency"]
+
+    good = latency_config.get("good")
+
+    if good is not None and \
+            any(latency <= good for latency in latencies.values()):
+        # A known host is good enough, don't wait for the stale ones.
+        stale = []
+
+    if stale:
+        results = probe_latency(stale, latency_config, good)
+
+        table = health.record(results, health_config.get("alpha"))
+
+        for host, latency in results.items():
+            if latency is None:
+                continue
+
+            latencies[host] = health.get(table, host, max_age)["latency"]
+
+    if not latencies:
+        return None
+
+    selected = min(latencies, key=latencies.get)
+
+    info("%s:%d = %.2fms" % (selected[0], selected[1], latencies[selected]))
+
+    return selected
+
+# Uses the capacity that each node reports with its metrics. See cmd_metrics().
+def select_by_capacity(hosts, algo, profile, config):
+    nodes = config.get("nodes")
+
+    resources = get_profile_resources(profile, config)
+
+    capacity = get_nodes_capacity(config)
+
+    selected = None
+    selected_score = None
+
+    for node_id, node_capacity in capacity.items():
+        host = nodes.get(node_id)
+
+        if host is None or host not in hosts:
+            continue
+
+        limits = node_capacity.get("limits")
+        allocated = node_capacity.get("allocated")
+
+        fits = True
+        free = []
+
+        for resource in ("memory", "storage"):
+            limit = limits.get(resource)
+
+            if limit is None:
+                continue
+
+            left = limit - allocated.get(resource, 0) - resources[resource]
+
+            if left <= 0:
+                fits = False
+                break
+
+            free.append(left / limit)
+
+        if not fits:
+            info("%s: %s does not fit" % (node_id, profile))
+            continue
+
+        # The headroom of a node is the fraction left of its scarcest resource.
+        if not free:
+            headroom = 1.0
+        else:
+            headroom = min(free)
+
+        if algo == "least-loaded":
+            score = headroom
+        else:
+            # best-fit: the tightest node is the best one.
+            score = -headroom
+
+        info("%s: score = %.4f" % (node_id, score))
+
+        if selected_score is None or score > selected_score:
+            selected = host
+            selected_score = score
+
+    return selected
+
+def cmd_series(argv, config):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Display the metrics reported by the nodes over time"
+    )
+
+    parser.add_argument("--node",
+        help="Only the metrics of this node"
+    )
+    parser.add_argument("--vm",
+        help="Only the metrics of this virtual machine ('%s' for the totals of the node)" % series.TOTAL
+    )
+    parser.add_argument("--metric",
+        help="Only this metric (e.g. 'memory-usage', 'rx' or 'rctl.pcpu')"
+    )
+    parser.add_argument("--since",
+        help="Only the metrics newer than this timespan (e.g. '1d')"
+    )
+    parser.add_argument("--until",
+        help="Only the metrics older than this timespan (e.g. '1h')"
+    )
+    parser.add_argument("--resolution",
+        help="Raw metrics or hourly or daily rollups (default: %(default)s)",
+        choices=[resolution[0] for resolution in series.RESOLUTIONS],
+        default="raw"
+    )
+    parser.add_argument("--top",
+        help="Display the virtual machines with the highest value of '--metric'",
+        type=int
+    )
+    parser.add_argument("--by",
+        help="How the virtual machines are ranked with '--top' (default: %(default)s)",
+        choices=("avg", "max", "last", "delta"),
+        default="avg"
+    )
+
+    args = parser.parse_args(argv[1:])
+
+    now = time.time()
+
+    since = args.since
+
+    if since is not None:
+        since = now - parse_timespan(since)
+
+    until = args.until
+
+    if until is not None:
+        until = now - parse_timespan(until)
+
+    if args.top is not None:
+        if args.metric is None:
+            err("--metric is required by --top!")
+            return EX_USAGE
+
+        ranking = series.top(SERIESDIR, args.metric, args.top, args.by,
+            node=args.node,
+            since=since,
+            until=until,
+            resolution=args.resolution
+        )
+
+        print(json.dumps(ranking, indent=4))
+
+        return EX_OK
+
+    points = series.query(SERIESDIR,
+        node=args.node,
+        vm=args.vm,
+        metric=args.metric,
+        since=since,
+        until=until,
+        resolution=args.resolution
+    )
+
+    # One series per line, as they are read.
+    for (node, key, node_points) in points:
+        (vm, metric) = key.split("/", 1)
+
+        print(json.dumps({
+            "node-id" : node,
+            "vm" : vm,
+            "metric" : metric,
+            "points" : node_points
+        }), flush=True)
+
+    return EX_OK
+
+# The capacity of a node that has not reported it for 'capacity.max-age' is
+# ignored: the node may be down.
+def get_nodes_capacity(config):
+    nodes = config.get("nodes")
+
+    since = time.time() - config.get("capacity").get("max-age")
+
+    capacity = {}
+
+    # Only the latest metrics of each node are used.
+    for (_, _, message) in logstore.query(LOGDIR, since=since, context="metrics", reverse=True):
+        node_id = message.get("node-id")
+
+        if node_id in capacity or message.get("capacity") is None:
+            continue
+
+        capacity[node_id] = message["capacity"]
+
+        if nodes and all(node in capacity for node in nodes):
+            break
+
+    return capacity
+
+def probe_latency(hosts, latency_config, good=None):
+    runs = latency_config.get("runs")
+    timeout = latency_config.get("timeout")
+    deadline = latency_config.get("deadline")
+
+    stop = threading.Event()
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(DEFAULT_LATENCY_JOBS, len(hosts))
+    )
+
+    futures = {
+        executor.submit(measure_latency, host, runs, timeout, stop) : host
+            for host in hosts
+    }
+
+    results = {}
+
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=deadline):
+            host = futures[future]
+
+            latency = future.result()
+
+            results[host] = latency
+
+            if latency is None:
+                warn("%s:%d is unreachable" % (host[0], host[1]))
+                continue
+
+            info("%s:%d = %.2fms (probed)" % (host[0], host[1], latency))
+
+            if good is not None and latency <= good:
+                info("%s:%d is good enough (%.2fms <= %.2fms)" % (host[0], host[1], latency, good))
+                break
+    except concurrent.futures.TimeoutError:
+        warn("Deadline reached (%ds), the remaining hosts are ignored" % deadline)
+    finally:
+        # The remaining probes stop after their current connection attempt.
+        stop.set()
+
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+def measure_latency(host, runs, timeout, stop):
+    latencies = []
+
+    for _ in range(runs):
+        if stop.is_set():
+            break
+
+        latency = tcp_latency.latency_point(host[0], host[1], timeout=timeout)
+
+        # Don't waste the remaining runs on an unreachable host.
+        if latency is None:
+            return None
+
+        latencies.append(latency)
+
+    if not latencies:
+        return None
+
+    return statistics.mean(latencies)
+
+# A job that cannot be decoded is buried, so it is not reserved again.
+def reserve(client, parse_json=True, timeout=None):
+    job = client.reserve(timeout=timeout)
+
+    info("Reserved (job:%d)" % job.id)
+
+    try:
+        json_message = decode(job.body)
+
+        if parse_json:
+            message = json.loads(json_message)
+
+            if not isinstance(message, dict):
+                raise ValueError("not an object")
+        else:
+            message = json_message
+    except (zlib.error, ValueError) as e:
+        err("Invalid job (job:%d): %s" % (job.id, e))
+
+        bury(client, job)
+
+        raise InvalidJob(job.id)
+
+    return (job, message)
+
+# Returns False when the connection cannot be used anymore.
+def bury(client, job):
+    try:
+        client.bury(job)
+    except greenstalk.NotFoundError:
+        # Already deleted.
+        pass
+    except (OSError, greenstalk.UnknownResponseError) as e:
+        err("Could not bury the job (job:%d): %s" % (job.id, e))
+
+        return False
+    else:
+        info("Buried (job:%d)" % job.id)
+
+    return True
+
+def put(message, tube, host, port, config):
+    return put_many([message], tube, host, port, config)[0]
+
+# Submits all the messages using the same connection.
+def put_many(messages, tube, host, port, config):
+    ttr = config.get("ttr")
+
+    info("Creating %d job(s) in %s:%d (tube:%s, ttr:%d)" % (len(messages), host, port, tube, ttr))
+
+    encoding = config.get("encoding")
+
+    bodies = [encode(message, encoding) for message in messages]
+
+    return CLIENTS.put(bodies, tube, host, port, ttr)
 
-        info("selection:%s = %s:%d" % (algo, host[0], host[1]))
+# Jobs equal to or larger than 'encoding.threshold' are compressed when the
+# format is 'zlib'. Readers detect the format of each job, so they must be
+# updated before the writers.
+def encode(message, encoding):
+    body = json.dumps(message).encode()
 
-        selected_hosts.append(host)
-    elif algo == "single":
-        if arg is None:
-            raise ArgumentRequired("'single' algorithm requires an argument!")
+    if encoding.get("format") == "zlib" \
+            and len(body) >= encoding.get("threshold"):
+        body = ZLIB_HEADER + zlib.compress(body)
 
-        selected = None
+    return body
 
-        (selected_host, selected_port) = parse_host(arg)
+def decode(body):
+    if body.startswith(ZLIB_HEADER):
+        body = zlib.decompress(body[len(ZLIB_HEADER):])
 
-        for host in hosts:
-            if host[0] == selected_host and \
-                    host[1] == selected_port:
-                selected = host
-                break
+    return body.decode()
 
-        host = selected
+# Calls func(host, port) for all the hosts at the same time, so each host
+# costs a single round trip instead of waiting for the previous ones.
+def fan_out(func, hosts, jobs=DEFAULT_FANOUT_JOBS):
+    if not hosts:
+        return
 
-        if host is None:
-            raise HostNotFound(f"Match not found for host '{selected_host}:{selected_port}'")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(jobs, len(hosts))) as executor:
+        futures = {}
 
-        info("selection:%s = %s:%d" % (algo, host[0], host[1]))
+        for host in hosts:
+            futures[executor.submit(func, *host)] = host
 
-        selected_hosts.append(host)
-    else:
-        raise InvalidAlgorithm(f"Invalid algorithm '{algo}'")
+        for future in concurrent.futures.as_completed(futures):
+            (host, port) = futures[future]
 
-    return selected_hosts
+            try:
+                future.result()
+            except Exception as e:
+                warn("Exception (%s:%d): %s" % (host, port, e))
 
-def watch(tube, host, port, parse_json=True):
-    client = connect(host, port)
+def connect(host, port):
+    info("Connecting (%s:%d)" % (host, port))
 
-    info("Watching (tube:%s)" % tube)
+    return greenstalk.Client((host, port), encoding=None)
 
-    client.watch(tube)
+# Connections used to submit jobs, one per host. They are kept open for the
+# whole command, or for the whole life of a worker, which reports the status
+# of every job to the same host.
+class ClientPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
 
-    job = client.reserve()
+    def put(self, bodies, tube, host, port, ttr):
+        with self.lock:
+            entry = self.clients.setdefault((host, port), {
+                "client" : None,
+                "tube" : None,
+                "lock" : threading.Lock()
+            })
 
-    info("Reserved (job:%d)" % job.id)
+        jobs = []
 
-    json_message = job.body
+        with entry["lock"]:
+            # A connection that has been idle may have been closed by the
+            # other end, so a reused connection is retried once with a new one.
+            # Only the jobs not yet created are submitted again.
+            retry = entry["client"] is not None
 
-    if parse_json:
-        message = json.loads(json_message)
-    else:
-        message = json_message
+            while True:
+                try:
+                    if entry["client"] is None:
+                        entry["client"] = connect(host, port)
+                        entry["tube"] = None
 
-    return (job, message, client)
+                    client = entry["client"]
 
-def put(message, tube, host, port, config):
-    client = connect(host, port)
+                    if entry["tube"] != tube:
+                        info("Using (tube:%s)" % tube)
 
-    info("Using (tube:%s)" % tube)
+                        client.use(tube)
 
-    client.use(tube)
+                        entry["tube"] = tube
 
-    json_message = json.dumps(message)
+                    for body in bodies[len(jobs):]:
+                        jobs.append(client.put(body, ttr=ttr))
 
-    ttr = config.get("ttr")
+                    return jobs
+                except (OSError, greenstalk.UnknownResponseError):
+                    self.discard(entry)
 
-    info("Creating job (ttr:%d)" % ttr)
+                    if not retry:
+                        raise
 
-    job = client.put(json_message, ttr=ttr)
+                    retry = False
 
-    client.close()
+    def discard(self, entry):
+        if entry["client"] is not None:
+            try:
+                entry["client"].close()
+            except Exception:
+                pass
 
-    return job
+        entry["client"] = None
+        entry["tube"] = None
 
-def connect(host, port):
-    info("Connecting (%s:%d)" % (host, port))
+    def close(self):
+        with self.lock:
+            for entry in self.clients.values():
+                with entry["lock"]:
+                    self.discard(entry)
 
-    return greenstalk.Client((host, port))
+            self.clients = {}
 
 def getconfig(config):
     with open(config) as fd:
@@ -751,7 +2325,16 @@ def checkconfig(config):
         "limits",
         "overload",
         "metrics",
-        "logs"
+        "logs",
+        "worker",
+        "capacity",
+        "destroy",
+        "pool",
+        "latency",
+        "health",
+        "nodes",
+        "encoding",
+        "series"
     )
 
     for k2 in config.keys():
@@ -836,9 +2419,23 @@ def checkconfig(config):
 
     forward_next = forward.get("next")
 
-    if forward_next is not None and \
-            not isinstance(forward_next, str):
-        raise TypeError("Key 'forward.next' must be a string.")
+    if forward_next is None:
+        forward_next = []
+    elif isinstance(forward_next, str):
+        forward_next = [forward_next]
+    elif isinstance(forward_next, list):
+        pass
+    else:
+        raise TypeError("Key 'forward.next' must be a string or a list.")
+
+    for nro, forward_host in enumerate(forward_next, 1):
+        if not isinstance(forward_host, str):
+            raise TypeError(f"Forward host #{nro}:{forward_host} has an invalid type!")
+
+    forward_policy = forward.get("policy", DEFAULT_FORWARD_POLICY)
+
+    if forward_policy not in DEFAULT_FORWARD_POLICIES:
+        raise ValueError(f"Key 'forward.policy' must be one of {DEFAULT_FORWARD_POLICIES}.")
 
     forward_max = forward.get("max", DEFAULT_FORWARD_MAX)
 
@@ -850,7 +2447,7 @@ def checkconfig(config):
     if not isinstance(limits, dict):
         raise TypeError("Key 'limits' must be a dict.")
 
-    limits_keys = ("memory", "storage")
+    limits_keys = ("memory", "storage", "reconcile")
 
     for k2 in limits.keys():
         if k2 not in limits_keys:
@@ -876,12 +2473,21 @@ def checkconfig(config):
         else:
             raise TypeError("Key 'limits.storage' must be an integer.")
 
+    limits_reconcile = limits.get("reconcile", DEFAULT_LIMITS_RECONCILE)
+
+    if isinstance(limits_reconcile, str):
+        limits_reconcile = parse_timespan(limits_reconcile)
+    elif isinstance(limits_reconcile, int):
+        pass
+    else:
+        raise TypeError("Key 'limits.reconcile' must be an integer.")
+
     overload = config.get("overload", {})
 
     if not isinstance(overload, dict):
         raise TypeError("Key 'overload' must be a dict.")
 
-    overload_keys = ("memory-usage", "rx", "tx", "rctl")
+    overload_keys = ("memory-usage", "rx", "tx", "rctl", "rates")
 
     for k2 in overload.keys():
         if k2 not in overload_keys:
@@ -1059,6 +2665,28 @@ def checkconfig(config):
                 not isinstance(overload_rctl_nthr, int):
             raise TypeError("Key 'overload.rctl.nthr' must be an integer.")
 
+        overload_rctl_msgqqueued = overload_rctl.get("msgqqueued")
+
+        if overload_rctl_msgqqueued is not None and \
+                not isinstance(overload_rctl_msgqqueued, int):
+            raise TypeError("Key 'overload.rctl.msgqqueued' must be an integer.")
+
+        overload_rctl_msgqsize = overload_rctl.get("msgqsize")
+
+        if overload_rctl_msgqsize is not None:
+            if isinstance(overload_rctl_msgqsize, str):
+                overload_rctl_msgqsize = parse_size(overload_rctl_msgqsize, binary=True)
+            elif isinstance(overload_rctl_msgqsize, int):
+                pass
+            else:
+                raise TypeError("Key 'overload.rctl.msgqsize' must be an integer.")
+
+        overload_rctl_nmsgq = overload_rctl.get("nmsgq")
+
+        if overload_rctl_nmsgq is not None and \
+                not isinstance(overload_rctl_nmsgq, int):
+            raise TypeError("Key 'overload.rctl.nmsgq' must be an integer.")
+
         overload_rctl_nsem = overload_rctl.get("nsem")
 
         if overload_rctl_nsem is not None and \
@@ -1139,7 +2767,7 @@ def checkconfig(config):
             "cputime" : overload_rctl_cputime,
             "datasize" : overload_rctl_datasize,
             "stacksize" : overload_rctl_stacksize,
-            "coredumpsize" : overload_rctl_coredump,
+            "coredumpsize" : overload_rctl_coredumpsize,
             "memoryuse" : overload_rctl_memoryuse,
             "memorylocked" : overload_rctl_memorylocked,
             "maxproc" : overload_rctl_maxproc,
@@ -1163,6 +2791,94 @@ def checkconfig(config):
             "writeiops" : overload_rctl_writeiops
         }
 
+    overload_rates = overload.get("rates", {})
+
+    if overload_rates:
+        if not isinstance(overload_rates, dict):
+            raise TypeError("Key 'overload.rates' must be a dict.")
+
+        overload_rates_keys = (
+            "rx",
+            "tx",
+            "pcpu",
+            "readbps",
+            "writebps",
+            "readiops",
+            "writeiops"
+        )
+
+        for k2 in overload_rates.keys():
+            if k2 not in overload_rates_keys:
+                raise KeyError(f"Key 'overload.rates.{k2}' is not valid.")
+
+        overload_rates_rx = overload_rates.get("rx")
+
+        if overload_rates_rx is not None:
+            if isinstance(overload_rates_rx, str):
+                overload_rates_rx = parse_size(overload_rates_rx, binary=True)
+            elif isinstance(overload_rates_rx, int):
+                pass
+            else:
+                raise TypeError("Key 'overload.rates.rx' must be an integer.")
+
+        overload_rates_tx = overload_rates.get("tx")
+
+        if overload_rates_tx is not None:
+            if isinstance(overload_rates_tx, str):
+                overload_rates_tx = parse_size(overload_rates_tx, binary=True)
+            elif isinstance(overload_rates_tx, int):
+                pass
+            else:
+                raise TypeError("Key 'overload.rates.tx' must be an integer.")
+
+        overload_rates_pcpu = overload_rates.get("pcpu")
+
+        if overload_rates_pcpu is not None and \
+                not isinstance(overload_rates_pcpu, int):
+            raise TypeError("Key 'overload.rates.pcpu' must be an integer.")
+
+        overload_rates_readbps = overload_rates.get("readbps")
+
+        if overload_rates_readbps is not None:
+            if isinstance(overload_rates_readbps, str):
+                overload_rates_readbps = parse_size(overload_rates_readbps, binary=True)
+            elif isinstance(overload_rates_readbps, int):
+                pass
+            else:
+                raise TypeError("Key 'overload.rates.readbps' must be an integer.")
+
+        overload_rates_writebps = overload_rates.get("writebps")
+
+        if overload_rates_writebps is not None:
+            if isinstance(overload_rates_writebps, str):
+                overload_rates_writebps = parse_size(overload_rates_writebps, binary=True)
+            elif isinstance(overload_rates_writebps, int):
+                pass
+            else:
+                raise TypeError("Key 'overload.rates.writebps' must be an integer.")
+
+        overload_rates_readiops = overload_rates.get("readiops")
+
+        if overload_rates_readiops is not None and \
+                not isinstance(overload_rates_readiops, int):
+            raise TypeError("Key 'overload.rates.readiops' must be an integer.")
+
+        overload_rates_writeiops = overload_rates.get("writeiops")
+
+        if overload_rates_writeiops is not None and \
+                not isinstance(overload_rates_writeiops, int):
+            raise TypeError("Key 'overload.rates.writeiops' must be an integer.")
+
+        overload_rates = {
+            "rx" : overload_rates_rx,
+            "tx" : overload_rates_tx,
+            "pcpu" : overload_rates_pcpu,
+            "readbps" : overload_rates_readbps,
+            "writebps" : overload_rates_writebps,
+            "readiops" : overload_rates_readiops,
+            "writeiops" : overload_rates_writeiops
+        }
+
     metrics = config.get("metrics", {})
 
     if not isinstance(metrics, dict):
@@ -1186,9 +2902,17 @@ def checkconfig(config):
     else:
         raise TypeError("Key 'metrics.skew' must be an integer.")
 
+    metrics_full_every = metrics.get("full-every", DEFAULT_METRICS_FULL_EVERY)
+
+    if not isinstance(metrics_full_every, int):
+        raise TypeError("Key 'metrics.full-every' must be an integer.")
+
+    if metrics_full_every < 1:
+        raise ValueError("Key 'metrics.full-every' must be greater than or equal to 1.")
+
     logs = config.get("logs", {})
 
-    if not isinstance(metrics, dict):
+    if not isinstance(logs, dict):
         raise TypeError("Key 'logs' must be a dict.")
 
     logs_remove_after = logs.get("remove-after", {})
@@ -1242,12 +2966,282 @@ def checkconfig(config):
 
         logs_remove_after_weeks = parse_timespan("%d week" % logs_remove_after_weeks)
 
-    logs_remove_count = logs_remove_after.get("count")
+    logs_remove_count = logs.get("remove-count")
 
     if logs_remove_count is not None and \
             not isinstance(logs_remove_count, int):
         raise TypeError("Key 'logs.remove-count' must be an integer.")
 
+    logs_segment_size = logs.get("segment-size", DEFAULT_LOGS_SEGMENT_SIZE)
+
+    if isinstance(logs_segment_size, str):
+        logs_segment_size = parse_size(logs_segment_size, binary=True)
+    elif isinstance(logs_segment_size, int):
+        pass
+    else:
+        raise TypeError("Key 'logs.segment-size' must be an integer.")
+
+    logs_max_bytes = logs.get("max-bytes")
+
+    if isinstance(logs_max_bytes, str):
+        logs_max_bytes = parse_size(logs_max_bytes, binary=True)
+    elif logs_max_bytes is None or isinstance(logs_max_bytes, int):
+        pass
+    else:
+        raise TypeError("Key 'logs.max-bytes' must be an integer.")
+
+    worker = config.get("worker", {})
+
+    if not isinstance(worker, dict):
+        raise TypeError("Key 'worker' must be a dict.")
+
+    worker_max_jobs = worker.get("max-jobs", DEFAULT_WORKER_MAX_JOBS)
+
+    if not isinstance(worker_max_jobs, int):
+        raise TypeError("Key 'worker.max-jobs' must be an integer.")
+
+    worker_max_lifetime = worker.get("max-lifetime", DEFAULT_WORKER_MAX_LIFETIME)
+
+    if isinstance(worker_max_lifetime, str):
+        worker_max_lifetime = parse_timespan(worker_max_lifetime)
+    elif isinstance(worker_max_lifetime, int):
+        pass
+    else:
+        raise TypeError("Key 'worker.max-lifetime' must be an integer.")
+
+    worker_concurrency = worker.get("concurrency", DEFAULT_WORKER_CONCURRENCY)
+
+    if not isinstance(worker_concurrency, int):
+        raise TypeError("Key 'worker.concurrency' must be an integer.")
+
+    worker_output_lines = worker.get("output-lines", DEFAULT_WORKER_OUTPUT_LINES)
+
+    if not isinstance(worker_output_lines, int):
+        raise TypeError("Key 'worker.output-lines' must be an integer.")
+
+    if worker_output_lines < 1:
+        raise ValueError("Key 'worker.output-lines' must be greater than or equal to 1.")
+
+    capacity = config.get("capacity", {})
+
+    if not isinstance(capacity, dict):
+        raise TypeError("Key 'capacity' must be a dict.")
+
+    capacity_ttl = capacity.get("ttl", DEFAULT_CAPACITY_TTL)
+
+    if isinstance(capacity_ttl, str):
+        capacity_ttl = parse_timespan(capacity_ttl)
+    elif isinstance(capacity_ttl, int):
+        pass
+    else:
+        raise TypeError("Key 'capacity.ttl' must be an integer.")
+
+    capacity_window = capacity.get("window", DEFAULT_CAPACITY_WINDOW)
+
+    if isinstance(capacity_window, str):
+        capacity_window = parse_timespan(capacity_window)
+    elif isinstance(capacity_window, int):
+        pass
+    else:
+        raise TypeError("Key 'capacity.window' must be an integer.")
+
+    capacity_max_age = capacity.get("max-age", DEFAULT_CAPACITY_MAX_AGE)
+
+    if capacity_max_age is None:
+        # A few metrics reports may be lost before a node is ignored.
+        capacity_max_age = max(
+            DEFAULT_CAPACITY_REPORTS * (metrics_delay + metrics_skew),
+            DEFAULT_CAPACITY_MIN_AGE
+        )
+    elif isinstance(capacity_max_age, str):
+        capacity_max_age = parse_timespan(capacity_max_age)
+    elif isinstance(capacity_max_age, int):
+        pass
+    else:
+        raise TypeError("Key 'capacity.max-age' must be an integer.")
+
+    destroy = config.get("destroy", {})
+
+    if not isinstance(destroy, dict):
+        raise TypeError("Key 'destroy' must be a dict.")
+
+    destroy_concurrency = destroy.get("concurrency", DEFAULT_DESTROY_CONCURRENCY)
+
+    if not isinstance(destroy_concurrency, int):
+        raise TypeError("Key 'destroy.concurrency' must be an integer.")
+
+    if destroy_concurrency < 1:
+        raise ValueError("Key 'destroy.concurrency' must be greater than or equal to 1.")
+
+    destroy_io_concurrency = destroy.get("io-concurrency", DEFAULT_DESTROY_IO_CONCURRENCY)
+
+    if not isinstance(destroy_io_concurrency, int):
+        raise TypeError("Key 'destroy.io-concurrency' must be an integer.")
+
+    if destroy_io_concurrency < 1:
+        raise ValueError("Key 'destroy.io-concurrency' must be greater than or equal to 1.")
+
+    destroy_timeout = destroy.get("timeout", DEFAULT_DESTROY_TIMEOUT)
+
+    if destroy_timeout is None:
+        pass
+    elif isinstance(destroy_timeout, str):
+        destroy_timeout = parse_timespan(destroy_timeout)
+    elif isinstance(destroy_timeout, int):
+        pass
+    else:
+        raise TypeError("Key 'destroy.timeout' must be an integer.")
+
+    pool = config.get("pool", {})
+
+    if not isinstance(pool, dict):
+        raise TypeError("Key 'pool' must be a dict.")
+
+    pool_profiles = pool.get("profiles", {})
+
+    if not isinstance(pool_profiles, dict):
+        raise TypeError("Key 'pool.profiles' must be a dict.")
+
+    for pool_profile, pool_size in pool_profiles.items():
+        if pool_profile not in profiles:
+            raise ValueError(f"Key 'pool.profiles.{pool_profile}' is not a valid profile.")
+
+        if not isinstance(pool_size, int):
+            raise TypeError(f"Key 'pool.profiles.{pool_profile}' must be an integer.")
+
+    pool_delay = pool.get("delay", DEFAULT_POOL_DELAY)
+
+    if isinstance(pool_delay, str):
+        pool_delay = parse_timespan(pool_delay)
+    elif isinstance(pool_delay, int):
+        pass
+    else:
+        raise TypeError("Key 'pool.delay' must be an integer.")
+
+    latency = config.get("latency", {})
+
+    if not isinstance(latency, dict):
+        raise TypeError("Key 'latency' must be a dict.")
+
+    latency_runs = latency.get("runs", DEFAULT_LATENCY_RUNS)
+
+    if not isinstance(latency_runs, int):
+        raise TypeError("Key 'latency.runs' must be an integer.")
+
+    if latency_runs < 1:
+        raise ValueError("Key 'latency.runs' must be greater than or equal to 1.")
+
+    latency_timeout = latency.get("timeout", DEFAULT_LATENCY_TIMEOUT)
+
+    if isinstance(latency_timeout, str):
+        latency_timeout = parse_timespan(latency_timeout)
+    elif isinstance(latency_timeout, (int, float)):
+        pass
+    else:
+        raise TypeError("Key 'latency.timeout' must be a number.")
+
+    latency_deadline = latency.get("deadline", DEFAULT_LATENCY_DEADLINE)
+
+    if isinstance(latency_deadline, str):
+        latency_deadline = parse_timespan(latency_deadline)
+    elif isinstance(latency_deadline, (int, float)):
+        pass
+    else:
+        raise TypeError("Key 'latency.deadline' must be a number.")
+
+    latency_good = latency.get("good", DEFAULT_LATENCY_GOOD)
+
+    if latency_good is not None and \
+            not isinstance(latency_good, (int, float)):
+        raise TypeError("Key 'latency.good' must be a number.")
+
+    health_config = config.get("health", {})
+
+    if not isinstance(health_config, dict):
+        raise TypeError("Key 'health' must be a dict.")
+
+    health_interval = health_config.get("interval", DEFAULT_HEALTH_INTERVAL)
+
+    if isinstance(health_interval, str):
+        health_interval = parse_timespan(health_interval)
+    elif isinstance(health_interval, int):
+        pass
+    else:
+        raise TypeError("Key 'health.interval' must be an integer.")
+
+    health_max_age = health_config.get("max-age", DEFAULT_HEALTH_MAX_AGE)
+
+    if isinstance(health_max_age, str):
+        health_max_age = parse_timespan(health_max_age)
+    elif isinstance(health_max_age, int):
+        pass
+    else:
+        raise TypeError("Key 'health.max-age' must be an integer.")
+
+    health_alpha = health_config.get("alpha", DEFAULT_HEALTH_ALPHA)
+
+    if not isinstance(health_alpha, (int, float)):
+        raise TypeError("Key 'health.alpha' must be a number.")
+
+    if health_alpha <= 0 or health_alpha > 1:
+        raise ValueError("Key 'health.alpha' must be greater than 0 and less than or equal to 1.")
+
+    health_max_failures = health_config.get("max-failures", DEFAULT_HEALTH_MAX_FAILURES)
+
+    if not isinstance(health_max_failures, int):
+        raise TypeError("Key 'health.max-failures' must be an integer.")
+
+    nodes = config.get("nodes", {})
+
+    if not isinstance(nodes, dict):
+        raise TypeError("Key 'nodes' must be a dict.")
+
+    for nodes_id, nodes_host in nodes.items():
+        if not isinstance(nodes_host, str):
+            raise TypeError(f"Key 'nodes.{nodes_id}' must be a string.")
+
+    encoding = config.get("encoding", {})
+
+    if not isinstance(encoding, dict):
+        raise TypeError("Key 'encoding' must be a dict.")
+
+    encoding_format = encoding.get("format", DEFAULT_ENCODING_FORMAT)
+
+    if encoding_format not in DEFAULT_ENCODING_FORMATS:
+        raise ValueError(f"Key 'encoding.format' must be one of {DEFAULT_ENCODING_FORMATS}.")
+
+    encoding_threshold = encoding.get("threshold", DEFAULT_ENCODING_THRESHOLD)
+
+    if isinstance(encoding_threshold, str):
+        encoding_threshold = parse_size(encoding_threshold, binary=True)
+    elif isinstance(encoding_threshold, int):
+        pass
+    else:
+        raise TypeError("Key 'encoding.threshold' must be an integer.")
+
+    series_config = config.get("series", {})
+
+    if not isinstance(series_config, dict):
+        raise TypeError("Key 'series' must be a dict.")
+
+    series_retention = {}
+
+    for (resolution, default) in (
+        ("raw", DEFAULT_SERIES_RAW),
+        ("hour", DEFAULT_SERIES_HOUR),
+        ("day", DEFAULT_SERIES_DAY)
+    ):
+        retention = series_config.get(resolution, default)
+
+        if isinstance(retention, str):
+            retention = parse_timespan(retention)
+        elif retention is None or isinstance(retention, int):
+            pass
+        else:
+            raise TypeError(f"Key 'series.{resolution}' must be an integer.")
+
+        series_retention[resolution] = retention
+
     safe_config["node-id"] = node_id
     safe_config["default-profile"] = default_profile
     safe_config["profiles"] = profiles
@@ -1259,22 +3253,26 @@ def checkconfig(config):
     safe_config["ttr"] = ttr
     safe_config["scripts"] = scripts
     safe_config["forward"] = {
-        "next" : forward_next,
-        "max" : forward_max
+        "next" : list(parse_hosts(forward_next)),
+        "max" : forward_max,
+        "policy" : forward_policy
     }
     safe_config["limits"] = {
         "memory" : limits_memory,
-        "storage" : limits_storage
+        "storage" : limits_storage,
+        "reconcile" : limits_reconcile
     }
     safe_config["overload"] = {
         "memory-usage" : overload_memory_usage,
         "rx" : overload_rx,
         "tx" : overload_tx,
-        "rctl" : overload_rctl
+        "rctl" : overload_rctl,
+        "rates" : overload_rates
     }
     safe_config["metrics"] = {
         "delay" : metrics_delay,
-        "skew" : metrics_skew
+        "skew" : metrics_skew,
+        "full-every" : metrics_full_every
     }
     safe_config["logs"] = {
         "remove-after" : {
@@ -1285,7 +3283,49 @@ def checkconfig(config):
             "seconds" : logs_remove_after_seconds,
             "weeks" : logs_remove_after_weeks,
         },
-        "count" : logs_remove_count
+        "remove-count" : logs_remove_count,
+        "max-bytes" : logs_max_bytes,
+        "segment-size" : logs_segment_size
+    }
+    safe_config["worker"] = {
+        "max-jobs" : worker_max_jobs,
+        "max-lifetime" : worker_max_lifetime,
+        "concurrency" : worker_concurrency,
+        "output-lines" : worker_output_lines
+    }
+    safe_config["capacity"] = {
+        "ttl" : capacity_ttl,
+        "window" : capacity_window,
+        "max-age" : capacity_max_age
+    }
+    safe_config["destroy"] = {
+        "concurrency" : destroy_concurrency,
+        "io-concurrency" : destroy_io_concurrency,
+        "timeout" : destroy_timeout
+    }
+    safe_config["pool"] = {
+        "profiles" : pool_profiles,
+        "delay" : pool_delay
+    }
+    safe_config["latency"] = {
+        "runs" : latency_runs,
+        "timeout" : latency_timeout,
+        "deadline" : latency_deadline,
+        "good" : latency_good
+    }
+    safe_config["nodes"] = {
+        nodes_id : parse_host(nodes_host) for nodes_id, nodes_host in nodes.items()
+    }
+    safe_config["health"] = {
+        "interval" : health_interval,
+        "max-age" : health_max_age,
+        "alpha" : health_alpha,
+        "max-failures" : health_max_failures
+    }
+    safe_config["series"] = series_retention
+    safe_config["encoding"] = {
+        "format" : encoding_format,
+        "threshold" : encoding_threshold
     }
 
     return safe_config
@@ -1302,21 +3342,48 @@ def parse_host(host):
     else:
         return (host, DEFAULT_PORT)
 
-def check_limits(limits):
-    prog = os.path.join(BASEDIR, "../get-total-limits.py")
+# As when the totals were read from the output of the get-*.py scripts, a
+# check is skipped (the job is admitted) when the totals cannot be collected,
+# e.g. because vm(1) or rctl(8) has failed.
+def check_capacity(config, reserved=None, pooled=False):
+    limits = config.get("limits")
 
-    process = subprocess.run([prog],
-                  stdout=subprocess.PIPE,
-                  stderr=subprocess.DEVNULL,
-                  text=True
-              )
+    try:
+        current_limits = ledger.get_total(limits.get("reconcile"))
+    except Exception as e:
+        warn("Exception while reading the allocated resources, the limits are not checked: %s" % e)
 
-    if process.stdout == "":
-        return True
+        current_limits = None
+
+    capacity = config.get("capacity")
+
+    ttl = capacity.get("ttl")
+    window = capacity.get("window")
+
+    try:
+        (current_metrics, current_rates) = collector.get_load(ttl, window)
+    except Exception as e:
+        warn("Exception while collecting the metrics, the overload is not checked: %s" % e)
+
+        current_metrics = None
+
+    if not pooled and current_limits is not None \
+            and not check_limits(limits, current_limits, reserved):
+        return False
+
+    if current_metrics is not None \
+            and not check_overload(config.get("overload"), current_metrics, reserved, current_rates):
+        return False
 
-    current = json.loads(process.stdout)
-    current_memory = current["memory"]
-    current_storage = current["storage"]
+    return True
+
+def check_limits(limits, current, reserved=None):
+    current_memory = current.memory
+    current_storage = current.storage
+
+    if reserved is not None:
+        current_memory += reserved["memory"]
+        current_storage += reserved["storage"]
 
     limits_memory = limits.get("memory")
     limits_storage = limits.get("storage")
@@ -1339,19 +3406,14 @@ def check_limits(limits):
 
     return True
 
-def check_overload(overload):
-    prog = os.path.join(BASEDIR, "../get-total-metrics.py")
-
-    process = subprocess.run([prog],
-                  stdout=subprocess.PIPE,
-                  stderr=subprocess.DEVNULL,
-                  text=True
-              )
-
-    if process.stdout == "":
-        return True
+# 'rx', 'tx' and the rctl(8) counters are totals since the VMs were started, so
+# 'rates' is usually more meaningful: they are per second and averaged over
+# 'capacity.window'.
+def check_overload(overload, current, reserved=None, rates=None):
+    current = current.todict()
 
-    current = json.loads(process.stdout)
+    if reserved is not None:
+        current["memory-usage"] += reserved["memory"]
 
     for overload_name, overload_value in overload.items():
         if overload_value is None:
@@ -1362,7 +3424,7 @@ def check_overload(overload):
                 if rctl_value is None:
                     continue
 
-                current_value = current[overload_name][rctl_name]
+                current_value = current[overload_name].get(rctl_name, 0)
 
                 if current_value >= rctl_value:
                     info("overload.rctl.%s: %d >= %d = True" % (rctl_name, current_value, rctl_value))
@@ -1370,6 +3432,27 @@ def check_overload(overload):
                     return False
                 else:
                     info("overload.rctl.%s: %d >= %d = False" % (rctl_name, current_value, rctl_value))
+        elif overload_name == "rates":
+            if rates is None:
+                if any(rate_value is not None for rate_value in overload_value.values()):
+                    info("overload.rates: not enough samples yet")
+
+                continue
+
+            current_rates = rates.todict()
+
+            for rate_name, rate_value in overload_value.items():
+                if rate_value is None:
+                    continue
+
+                current_value = current_rates[rate_name]
+
+                if current_value >= rate_value:
+                    info("overload.rates.%s: %.2f >= %d = True" % (rate_name, current_value, rate_value))
+
+                    return False
+                else:
+                    info("overload.rates.%s: %.2f >= %d = False" % (rate_name, current_value, rate_value))
         else:
             current_value = current[overload_name]
 
@@ -1382,6 +3465,47 @@ def check_overload(overload):
 
     return True
 
+def get_profile_resources(profile, config):
+    scripts = config.get("scripts")
+
+    resources = {
+        "memory" : 0,
+        "storage" : 0
+    }
+
+    template = os.path.join(scripts, "templates", "%s.conf" % profile)
+
+    if os.path.isfile(template):
+        with open(template) as fd:
+            for line in fd:
+                match = re.search(r'^memory="?([0-9]+[a-zA-Z]*)"?$', line.strip())
+
+                if match:
+                    resources["memory"] = parse_size(match.group(1), binary=True)
+
+    profile_script = os.path.join(scripts, "profiles", "%s.sh" % profile)
+
+    if os.path.isfile(profile_script):
+        with open(profile_script) as fd:
+            for line in fd:
+                match = re.search(r'^-s\s+"?([0-9]+[a-zA-Z]*)"?', line.strip())
+
+                if match:
+                    resources["storage"] = parse_size(match.group(1), binary=True)
+
+    return resources
+
+def handle_signals():
+    signal.signal(signal.SIGTERM, stop_worker)
+    signal.signal(signal.SIGINT, stop_worker)
+
+def stop_worker(signum, frame):
+    global WORKER_STOP
+
+    warn("Signal %d received, stopping after the current job" % signum)
+
+    WORKER_STOP = True
+
 def warn(msg):
     print(f"##!> {msg} <!##", file=sys.stderr)
 
@@ -1392,13 +3516,21 @@ def info(msg):
     print(f"===> {msg} <===", file=sys.stderr)
 
 def usage():
-    print("usage: cluster.py create [--options <options>] [--profile <profile>] [--select-algo <algo>]")
-    print("               [--select-arg <argument>] --tags <tags>")
-    print("       cluster.py logs")
-    print("       cluster.py status")
-    print("       cluster.py worker --tube [create|destroy|forward]")
-    print("       cluster.py destroy [--target <target>[:<port>]] --tags <value>")
+    print("usage: cluster.py create [--count <n>] [--options <options>] [--profile <profile>]")
+    print("               [--select-algo <algo>] [--select-arg <argument>] --tags <tags>")
+    print("       cluster.py logs [--batch <batch-id>]")
+    print("       cluster.py status [--persistent] [--batch-size <n>] [--max-jobs <n>]")
+    print("               [--max-lifetime <timespan>]")
+    print("       cluster.py worker --tube [create|destroy|forward] [--persistent] [--max-jobs <n>]")
+    print("               [--max-lifetime <timespan>] [--concurrency <n>]")
+    print("       cluster.py destroy [--target <target>[:<port>]] [--exact] --tags <value>")
     print("       cluster.py metrics")
+    print("       cluster.py pool [--once]")
+    print("       cluster.py health [--dump] [--once]")
+    print("       cluster.py timings [--node <node-id>] [--batch <batch-id>]")
+    print("       cluster.py series [--node <node-id>] [--vm <vm>] [--metric <metric>] [--since <timespan>]")
+    print("               [--until <timespan>] [--resolution [raw|hour|day]] [--top <n>]")
+    print("               [--by [avg|max|last|delta]]")
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
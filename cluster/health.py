@@ -0,0 +1,62 @@
+import os
+import time
+
+import state
+
+BASEDIR = os.path.dirname(os.path.realpath(__file__))
+
+HEALTH_FILE = os.path.join(BASEDIR, ".health.json")
+
+def load():
+    return state.load(HEALTH_FILE, {
+        "hosts" : {}
+    })
+
+def record(results, alpha):
+    now = time.time()
+
+    with state.lock(HEALTH_FILE):
+        table = load()
+
+        for host, latency in results.items():
+            update(table, host, latency, alpha, now)
+
+        state.save(HEALTH_FILE, table)
+
+    return table
+
+def update(table, host, latency, alpha, now):
+    entry = table["hosts"].setdefault(getkey(host), {
+        "latency" : None,
+        "last-seen" : None,
+        "last-probe" : None,
+        "failures" : 0
+    })
+
+    entry["last-probe"] = now
+
+    if latency is None:
+        entry["failures"] += 1
+        return
+
+    if entry["latency"] is None:
+        entry["latency"] = latency
+    else:
+        entry["latency"] = alpha * latency + (1 - alpha) * entry["latency"]
+
+    entry["last-seen"] = now
+    entry["failures"] = 0
+
+def get(table, host, max_age):
+    entry = table["hosts"].get(getkey(host))
+
+    if entry is None or entry["last-probe"] is None:
+        return None
+
+    if (time.time() - entry["last-probe"]) >= max_age:
+        return None
+
+    return entry
+
+def getkey(host):
+    return "%s:%d" % host
@@ -0,0 +1,322 @@
+import json
+import os
+import re
+import time
+
+import state
+
+# A segment is closed when it reaches this size.
+DEFAULT_SEGMENT_SIZE = 1024 * 1024 # 1M
+
+# Describes the segments in time order, so a query or the retention does not
+# need to read them.
+MANIFEST = "manifest.json"
+
+# Log files written by older versions of 'cluster.py status'.
+LEGACY_LOG = re.compile(r"^([0-9]+)\.json$")
+
+def load(logdir):
+    manifest = state.load(os.path.join(logdir, MANIFEST), {
+        "next-seq" : 1,
+        "segments" : []
+    })
+
+    # The totals are kept up to date, so the retention does not need to
+    # visit all the segments.
+    if "count" not in manifest:
+        manifest["count"] = sum(segment["count"] for segment in manifest["segments"])
+        manifest["bytes"] = sum(segment["bytes"] for segment in manifest["segments"])
+
+    return manifest
+
+# Appends the records, a list of (time, message), to the current segment. Each
+# message is a line in '<segment>.log' and its entry in '<segment>.idx' has the
+# time, the sequence number, where the line is and the fields used to filter.
+# A segment is closed when it reaches 'segment_size' bytes or 'segment_records'
+# records. The retention ('max-age', 'max-count' and 'max-bytes', see expire())
+# is applied afterwards and the removed segments are returned with the sequence
+# numbers.
+def append(logdir, records, segment_size=DEFAULT_SEGMENT_SIZE, segment_records=None, retention=None, sync=True):
+    manifest_file = os.path.join(logdir, MANIFEST)
+
+    with state.lock(manifest_file):
+        manifest = load(logdir)
+
+        segments = manifest["segments"]
+
+        seqs = []
+
+        data_fd = None
+        index_fd = None
+
+        try:
+            for (log_time, message) in records:
+                if not segments or segments[-1]["bytes"] >= segment_size \
+                        or (segment_records is not None and segments[-1]["count"] >= segment_records):
+                    if data_fd is not None:
+                        close_segment(data_fd, index_fd, sync)
+
+                        data_fd = index_fd = None
+
+                    segments.append(new_segment(manifest["next-seq"]))
+
+                segment = segments[-1]
+
+                if data_fd is None:
+                    (data_fd, index_fd) = open_segment(logdir, segment)
+
+                line = (json.dumps(message) + "\n").encode()
+
+                offset = data_fd.tell()
+
+                data_fd.write(line)
+
+                seq = manifest["next-seq"]
+
+                entry = json.dumps([
+                    log_time,
+                    seq,
+                    offset,
+                    len(line),
+                    message.get("node-id"),
+                    message.get("context")
+                ]) + "\n"
+
+                index_fd.write(entry)
+
+                if segment["first-time"] is None:
+                    segment["first-time"] = log_time
+
+                segment["last-time"] = log_time
+                segment["count"] += 1
+                segment["bytes"] += len(line)
+
+                if "index-bytes" in segment:
+                    segment["index-bytes"] += len(entry)
+
+                manifest["next-seq"] += 1
+                manifest["count"] += 1
+                manifest["bytes"] += len(line)
+
+                seqs.append(seq)
+        finally:
+            if data_fd is not None:
+                close_segment(data_fd, index_fd, sync)
+
+        removed = []
+
+        if retention is not None:
+            removed = expire(manifest,
+                retention.get("max-age"),
+                retention.get("max-count"),
+                retention.get("max-bytes")
+            )
+
+        state.save(manifest_file, manifest)
+
+        for segment in removed:
+            remove_segment(logdir, segment)
+
+    return (seqs, removed)
+
+def new_segment(seq):
+    return {
+        "name" : "%020d" % seq,
+        "first-time" : None,
+        "last-time" : None,
+        "count" : 0,
+        "bytes" : 0,
+        "index-bytes" : 0
+    }
+
+# The records written after the last saved manifest (e.g. the collector died
+# while writing them) are discarded, so they are not mixed with the new ones.
+def open_segment(logdir, segment):
+    data_fd = open(os.path.join(logdir, "%s.log" % segment["name"]), "ab")
+    index_fd = open(os.path.join(logdir, "%s.idx" % segment["name"]), "a")
+
+    data_fd.truncate(segment["bytes"])
+    data_fd.seek(0, os.SEEK_END)
+
+    # Segments created by older versions do not have it.
+    if "index-bytes" in segment:
+        index_fd.truncate(segment["index-bytes"])
+        index_fd.seek(0, os.SEEK_END)
+
+    return (data_fd, index_fd)
+
+def close_segment(data_fd, index_fd, sync):
+    for fd in (data_fd, index_fd):
+        fd.flush()
+
+        if sync:
+            os.fsync(fd.fileno())
+
+        fd.close()
+
+def remove_segment(logdir, segment):
+    for extension in ("log", "idx"):
+        state.remove(os.path.join(logdir, "%s.%s" % (segment["name"], extension)))
+
+# Yields (time, seq, message) in time order (or the newest first when 'reverse'
+# is used). Only the index of the segments that may contain records newer than
+# 'since' is read, and only the messages that match are parsed. 'context' also
+# matches its subcontexts, e.g. 'create' matches 'create.progress'.
+def query(logdir, since=None, node=None, context=None, limit=None, reverse=False):
+    segments = load(logdir)["segments"]
+
+    if reverse:
+        segments = reversed(segments)
+
+    found = 0
+
+    for segment in segments:
+        if since is not None and segment["last-time"] is not None \
+                and segment["last-time"] < since:
+            if reverse:
+                break
+
+            continue
+
+        try:
+            with open(os.path.join(logdir, "%s.idx" % segment["name"])) as fd:
+                entries = read_index(fd, segment["count"])
+
+            data_fd = open(os.path.join(logdir, "%s.log" % segment["name"]), "rb")
+        except FileNotFoundError:
+            # Removed by the retention.
+            continue
+
+        if reverse:
+            entries.reverse()
+
+        with data_fd:
+            for (log_time, seq, offset, length, log_node, log_context) in entries:
+                if since is not None and log_time < since:
+                    continue
+
+                if node is not None and log_node != node:
+                    continue
+
+                if context is not None and log_context != context \
+                        and not (log_context or "").startswith(context + "."):
+                    continue
+
+                data_fd.seek(offset)
+
+                yield (log_time, seq, json.loads(data_fd.read(length)))
+
+                found += 1
+
+                if limit is not None and found >= limit:
+                    return
+
+# Only the entries in the manifest are read: the index may have entries that
+# are being written (or were being written when the collector died).
+def read_index(fd, count):
+    entries = []
+
+    for line in fd:
+        if len(entries) >= count:
+            break
+
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            break
+
+    return entries
+
+def prune(logdir, max_age=None, max_count=None, max_bytes=None):
+    manifest_file = os.path.join(logdir, MANIFEST)
+
+    with state.lock(manifest_file):
+        manifest = load(logdir)
+
+        removed = expire(manifest, max_age, max_count, max_bytes)
+
+        if not removed:
+            return removed
+
+        state.save(manifest_file, manifest)
+
+        for segment in removed:
+            remove_segment(logdir, segment)
+
+    return removed
+
+# Removes from the manifest the oldest segments while they are older than
+# 'max_age' or there are more than 'max_count' records or 'max_bytes' bytes.
+# The segments are in time order, so it stops at the first segment that is
+# kept: the cost depends on the number of segments removed, not on the number
+# of logs.
+def expire(manifest, max_age=None, max_count=None, max_bytes=None):
+    segments = manifest["segments"]
+
+    now = time.time()
+
+    removed = []
+
+    while segments:
+        segment = segments[0]
+
+        expired = max_age is not None and segment["last-time"] is not None \
+            and (now - segment["last-time"]) > max_age
+
+        # The current segment is only removed because of its age.
+        exceeded = len(segments) > 1 and (
+            (max_count is not None and manifest["count"] > max_count)
+            or (max_bytes is not None and manifest["bytes"] > max_bytes)
+        )
+
+        if not expired and not exceeded:
+            break
+
+        segments.pop(0)
+
+        manifest["count"] -= segment["count"]
+        manifest["bytes"] -= segment["bytes"]
+
+        removed.append(segment)
+
+    return removed
+
+# Moves the '<epoch>.json' files into the log store.
+def migrate(logdir, segment_size=DEFAULT_SEGMENT_SIZE):
+    legacy = []
+
+    for log_file in os.listdir(logdir):
+        match = LEGACY_LOG.match(log_file)
+
+        if match:
+            legacy.append((int(match.group(1)), log_file))
+
+    if not legacy:
+        return 0
+
+    legacy.sort()
+
+    records = []
+
+    for (log_time, log_file) in legacy:
+        try:
+            with open(os.path.join(logdir, log_file)) as fd:
+                message = json.loads(fd.read())
+        except ValueError:
+            # It cannot be read by the old 'cluster.py logs' either.
+            continue
+
+        if not isinstance(message, dict):
+            message = {
+                "context" : "invalid",
+                "message" : message
+            }
+
+        records.append((log_time, message))
+
+    append(logdir, records, segment_size)
+
+    for (_, log_file) in legacy:
+        state.remove(os.path.join(logdir, log_file))
+
+    return len(legacy)
@@ -0,0 +1,325 @@
+import calendar
+import os
+import time
+
+import collector
+import state
+
+# Each resolution is stored in chunks of a period: (name, bucket, chunk format,
+# chunk length). The chunk length is an upper bound used by the retention.
+RESOLUTIONS = (
+    ("raw", None, "%Y-%m-%d", 60 * 60 * 24),
+    ("hour", 60 * 60, "%Y-%m", 60 * 60 * 24 * 31),
+    ("day", 60 * 60 * 24, "%Y", 60 * 60 * 24 * 366)
+)
+
+# Aggregates kept by the rollups for each bucket.
+ROLLUP_FIELDS = ("sum", "count", "min", "max", "last")
+
+# Pseudo virtual machine with the totals of the node.
+TOTAL = "total"
+
+# Last full metrics of the node, the base of its next delta.
+LAST = "last.json"
+
+# The metrics of a node are stored as columns: the times of the chunk and, for
+# each '<vm>/<metric>', the values at those times (None when missing). The
+# rollups keep, for each bucket, the aggregates of ROLLUP_FIELDS instead.
+def record(seriesdir, node, log_time, metrics, retention):
+    values = flatten(metrics)
+
+    nodedir = os.path.join(seriesdir, node)
+
+    for (resolution, bucket, chunk_format, chunk_length) in RESOLUTIONS:
+        resolutiondir = os.path.join(nodedir, resolution)
+
+        if not os.path.isdir(resolutiondir):
+            os.makedirs(resolutiondir, exist_ok=True)
+
+        chunk_file = os.path.join(resolutiondir, "%s.json" % time.strftime(chunk_format, time.gmtime(log_time)))
+
+        with state.lock(chunk_file):
+            chunk = state.load(chunk_file, {
+                "times" : [],
+                "series" : {}
+            })
+
+            if bucket is None:
+                append(chunk, log_time, values)
+            else:
+                rollup(chunk, log_time - (log_time % bucket), values)
+
+            state.save(chunk_file, chunk)
+
+        expire(resolutiondir, chunk_format, chunk_length, retention.get(resolution))
+
+# The metrics reports of a node are deltas against its previous report, except
+# the full snapshots ('base' is None). Returns the full metrics or None when the
+# base has not been received (a report has been lost) until the next snapshot.
+def restore(seriesdir, node, seq, base, metrics):
+    if seq is None:
+        # Reported by older nodes.
+        return metrics
+
+    nodedir = os.path.join(seriesdir, node)
+
+    if not os.path.isdir(nodedir):
+        os.makedirs(nodedir, exist_ok=True)
+
+    last_file = os.path.join(nodedir, LAST)
+
+    with state.lock(last_file):
+        if base is not None:
+            last = state.load(last_file)
+
+            if last is None or last["seq"] != base:
+                return None
+
+            metrics = collector.apply_delta(last["metrics"], metrics)
+
+        state.save(last_file, {
+            "seq" : seq,
+            "metrics" : metrics
+        })
+
+    return metrics
+
+# {vm : {metric : value, "rctl" : {resource : value}}} -> {"<vm>/<metric>" : value}
+# with the rctl(8) resources as 'rctl.<resource>'. The totals of all the virtual
+# machines are added as TOTAL.
+def flatten(metrics):
+    values = {}
+
+    for vm, vm_metrics in metrics.items():
+        for metric, value in vm_metrics.items():
+            if metric == "rctl":
+                for resource, rctl_value in (value or {}).items():
+                    values["%s/rctl.%s" % (vm, resource)] = rctl_value
+            else:
+                values["%s/%s" % (vm, metric)] = value
+
+    totals = {}
+
+    for key, value in values.items():
+        (_, metric) = key.split("/", 1)
+
+        if value is not None:
+            totals[metric] = totals.get(metric, 0) + value
+
+    for metric, value in totals.items():
+        values["%s/%s" % (TOTAL, metric)] = value
+
+    return values
+
+def append(chunk, log_time, values):
+    times = chunk["times"]
+    series = chunk["series"]
+
+    for key in values:
+        if key not in series:
+            series[key] = [None] * len(times)
+
+    times.append(log_time)
+
+    for key, column in series.items():
+        column.append(values.get(key))
+
+def rollup(chunk, bucket_time, values):
+    times = chunk["times"]
+    series = chunk["series"]
+
+    if not times or times[-1] != bucket_time:
+        times.append(bucket_time)
+
+        for column in series.values():
+            for field in ROLLUP_FIELDS:
+                column[field].append(None)
+
+    for key, value in values.items():
+        if value is None:
+            continue
+
+        if key not in series:
+            series[key] = {
+                field : [None] * len(times) for field in ROLLUP_FIELDS
+            }
+
+        column = series[key]
+
+        if column["count"][-1] is None:
+            column["sum"][-1] = value
+            column["count"][-1] = 1
+            column["min"][-1] = value
+            column["max"][-1] = value
+        else:
+            column["sum"][-1] += value
+            column["count"][-1] += 1
+            column["min"][-1] = min(column["min"][-1], value)
+            column["max"][-1] = max(column["max"][-1], value)
+
+        column["last"][-1] = value
+
+def expire(resolutiondir, chunk_format, chunk_length, max_age):
+    if max_age is None:
+        return
+
+    now = time.time()
+
+    for chunk_name in os.listdir(resolutiondir):
+        (period, extension) = os.path.splitext(chunk_name)
+
+        if extension != ".json":
+            continue
+
+        try:
+            start = calendar.timegm(time.strptime(period, chunk_format))
+        except ValueError:
+            continue
+
+        if (now - (start + chunk_length)) > max_age:
+            chunk_file = os.path.join(resolutiondir, chunk_name)
+
+            with state.lock(chunk_file):
+                state.remove(chunk_file)
+
+            state.remove("%s.lock" % chunk_file)
+
+def get_nodes(seriesdir):
+    if not os.path.isdir(seriesdir):
+        return []
+
+    return sorted(os.listdir(seriesdir))
+
+# Yields (node, "<vm>/<metric>", [(time, value), ...]) in time order. The value
+# of the rollups is a dict with 'avg', 'min', 'max' and 'last'. Only the chunks
+# of the range are read.
+def query(seriesdir, node=None, vm=None, metric=None, since=None, until=None, resolution="raw"):
+    (_, _, chunk_format, chunk_length) = get_resolution(resolution)
+
+    if node is None:
+        nodes = get_nodes(seriesdir)
+    else:
+        nodes = [node]
+
+    for node in nodes:
+        resolutiondir = os.path.join(seriesdir, node, resolution)
+
+        if not os.path.isdir(resolutiondir):
+            continue
+
+        points = {}
+
+        for chunk_name in sorted(os.listdir(resolutiondir)):
+            (period, extension) = os.path.splitext(chunk_name)
+
+            if extension != ".json":
+                continue
+
+            try:
+                start = calendar.timegm(time.strptime(period, chunk_format))
+            except ValueError:
+                continue
+
+            if since is not None and (start + chunk_length) < since:
+                continue
+
+            if until is not None and start > until:
+                continue
+
+            chunk = state.load(os.path.join(resolutiondir, chunk_name))
+
+            if chunk is None:
+                continue
+
+            for key, column in chunk["series"].items():
+                (key_vm, key_metric) = key.split("/", 1)
+
+                if vm is not None and key_vm != vm:
+                    continue
+
+                if metric is not None and key_metric != metric:
+                    continue
+
+                for index, log_time in enumerate(chunk["times"]):
+                    if since is not None and log_time < since:
+                        continue
+
+                    if until is not None and log_time > until:
+                        continue
+
+                    value = get_value(column, index)
+
+                    if value is None:
+                        continue
+
+                    points.setdefault(key, []).append((log_time, value))
+
+        for key in sorted(points):
+            yield (node, key, points[key])
+
+def get_value(column, index):
+    if isinstance(column, list):
+        return column[index]
+
+    count = column["count"][index]
+
+    if count is None:
+        return None
+
+    return {
+        "avg" : column["sum"][index] / count,
+        "min" : column["min"][index],
+        "max" : column["max"][index],
+        "last" : column["last"][index]
+    }
+
+# Returns the 'limit' virtual machines with the highest value of the metric in
+# the range: the average, the maximum, the last value or the increase ('delta',
+# for counters such as 'rx' or 'rctl.cputime').
+def top(seriesdir, metric, limit, by="avg", node=None, since=None, until=None, resolution="raw"):
+    ranking = []
+
+    for (key_node, key, points) in query(seriesdir, node, None, metric, since, until, resolution):
+        (vm, _) = key.split("/", 1)
+
+        if vm == TOTAL:
+            continue
+
+        values = [get_point_value(value, by) for (_, value) in points]
+
+        if by == "avg":
+            value = sum(values) / len(values)
+        elif by == "max":
+            value = max(values)
+        elif by == "last":
+            value = values[-1]
+        else:
+            value = values[-1] - values[0]
+
+        ranking.append({
+            "node-id" : key_node,
+            "vm" : vm,
+            "value" : value
+        })
+
+    ranking.sort(key=lambda entry: entry["value"], reverse=True)
+
+    return ranking[:limit]
+
+def get_point_value(value, by):
+    if not isinstance(value, dict):
+        return value
+
+    if by == "max":
+        return value["max"]
+    elif by == "avg":
+        return value["avg"]
+    else:
+        return value["last"]
+
+def get_resolution(resolution):
+    for entry in RESOLUTIONS:
+        if entry[0] == resolution:
+            return entry
+
+    raise ValueError("Invalid resolution '%s'" % resolution)
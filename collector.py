@@ -0,0 +1,560 @@
+import concurrent.futures
+import dataclasses
+import os
+import re
+import subprocess
+import time
+
+from humanfriendly import parse_size
+
+import state
+
+BASEDIR = os.path.dirname(os.path.realpath(__file__))
+
+# Number of VMs probed at the same time.
+DEFAULT_JOBS = 16
+
+# Metrics totals of the last collection. See get_capacity().
+CAPACITY_FILE = os.path.join(BASEDIR, ".capacity.json")
+
+# Last metrics reported by 'cluster.py metrics'. See get_report().
+REPORT_FILE = os.path.join(BASEDIR, ".report.json")
+
+# Recent samples used to compute the rates. See record_sample().
+RATES_FILE = os.path.join(BASEDIR, ".rates.json")
+
+# Rates are averaged over this window.
+DEFAULT_RATES_WINDOW = 60 * 5 # 5m
+
+# Maximum number of samples kept in the window.
+DEFAULT_RATES_SAMPLES = 64
+
+# Counters (cumulative since the VM started) converted to per-second rates.
+RATES_COUNTERS = ("rx", "tx")
+
+# rctl(8) resources that are already rates and are only averaged.
+RATES_GAUGES = ("pcpu", "readbps", "writebps", "readiops", "writeiops")
+
+# rctl(8) resources always present in the totals.
+RCTL_METRICS = (
+    "cputime",
+    "datasize",
+    "stacksize",
+    "coredumpsize",
+    "memoryuse",
+    "memorylocked",
+    "maxproc",
+    "openfiles",
+    "vmemoryuse",
+    "nthr",
+    "nsemop",
+    "wallclock",
+    "pcpu",
+    "readbps",
+    "writebps",
+    "readiops",
+    "writeiops"
+)
+
+@dataclasses.dataclass
+class Metrics:
+    memory_usage: int = 0
+    rx: int = 0
+    tx: int = 0
+    storage_usage: int = 0
+    rctl: dict = None
+
+    def todict(self):
+        return {
+            "memory-usage" : self.memory_usage,
+            "rx" : self.rx,
+            "tx" : self.tx,
+            "storage-usage" : self.storage_usage,
+            "rctl" : self.rctl
+        }
+
+    @classmethod
+    def fromdict(cls, metrics):
+        return cls(
+            memory_usage=metrics.get("memory-usage", 0),
+            rx=metrics.get("rx", 0),
+            tx=metrics.get("tx", 0),
+            storage_usage=metrics.get("storage-usage", 0),
+            rctl=metrics.get("rctl")
+        )
+
+@dataclasses.dataclass
+class Limits:
+    memory: int = 0
+    storage: int = 0
+
+    def todict(self):
+        return {
+            "memory" : self.memory,
+            "storage" : self.storage
+        }
+
+    @classmethod
+    def fromdict(cls, limits):
+        return cls(
+            memory=limits.get("memory", 0),
+            storage=limits.get("storage", 0)
+        )
+
+@dataclasses.dataclass
+class Rates:
+    rx: float = 0
+    tx: float = 0
+    pcpu: float = 0
+    readbps: float = 0
+    writebps: float = 0
+    readiops: float = 0
+    writeiops: float = 0
+
+    def todict(self):
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def fromdict(cls, rates):
+        return cls(**{
+            field.name : rates.get(field.name, 0) for field in dataclasses.fields(cls)
+        })
+
+def get_capacity(ttl, window=DEFAULT_RATES_WINDOW, jobs=DEFAULT_JOBS):
+    (metrics, _) = get_load(ttl, window, jobs)
+
+    return metrics
+
+# Returns the metrics totals and the rates averaged over the window (None when
+# there are not enough samples yet). A sample is taken each time the snapshot
+# is refreshed and by 'cluster.py metrics'.
+def get_load(ttl, window=DEFAULT_RATES_WINDOW, jobs=DEFAULT_JOBS):
+    snapshot = get_snapshot(ttl, window, jobs)
+
+    rates = snapshot.get("rates")
+
+    if rates is not None:
+        rates = Rates.fromdict(rates)
+
+    return (Metrics.fromdict(snapshot["metrics"]), rates)
+
+def get_snapshot(ttl, window, jobs):
+    snapshot = state.load(CAPACITY_FILE)
+
+    if not is_fresh(snapshot, ttl):
+        with state.lock(CAPACITY_FILE):
+            # Another process may have refreshed it while we were waiting.
+            snapshot = state.load(CAPACITY_FILE)
+
+            if not is_fresh(snapshot, ttl):
+                now = time.time()
+
+                metrics = collect_metrics(jobs)
+
+                rates = record_sample(metrics, window, now)
+
+                snapshot = {
+                    "time" : now,
+                    "metrics" : total_metrics(metrics).todict(),
+                    "rates" : None if rates is None else rates.todict()
+                }
+
+                state.save(CAPACITY_FILE, snapshot)
+
+    return snapshot
+
+def invalidate_capacity():
+    with state.lock(CAPACITY_FILE):
+        state.remove(CAPACITY_FILE)
+
+def is_fresh(snapshot, ttl):
+    if snapshot is None:
+        return False
+
+    return (time.time() - snapshot["time"]) < ttl
+
+def collect_limits(jobs=DEFAULT_JOBS):
+    vm_bhyve_dir = get_vm_dir()
+
+    if vm_bhyve_dir is None:
+        return {}
+
+    vm_machines = list(get_vm_machines(vm_bhyve_dir))
+
+    limits = {}
+
+    for (vm, vm_info) in probe(get_vm_info, vm_machines, jobs):
+        if vm_info is None:
+            continue
+
+        limits[vm] = parse_limits(vm_info)
+
+    return limits
+
+def collect_metrics(jobs=DEFAULT_JOBS):
+    running = get_running_machines()
+
+    metrics = {}
+
+    for (vm, vm_info) in probe(get_vm_info, list(running.keys()), jobs):
+        if vm_info is None:
+            continue
+
+        metrics[vm] = parse_metrics(vm_info)
+
+    for (vm, rctl) in probe(lambda vm: get_rctl(running[vm]), list(metrics.keys()), jobs):
+        metrics[vm].rctl = rctl
+
+    return metrics
+
+def total_limits(limits):
+    total = Limits()
+
+    for vm_limits in limits.values():
+        total.memory += vm_limits.memory
+        total.storage += vm_limits.storage
+
+    return total
+
+def total_metrics(metrics):
+    total = Metrics(rctl=dict.fromkeys(RCTL_METRICS, 0))
+
+    for vm_metrics in metrics.values():
+        total.memory_usage += vm_metrics.memory_usage
+        total.rx += vm_metrics.rx
+        total.tx += vm_metrics.tx
+        total.storage_usage += vm_metrics.storage_usage
+
+        if vm_metrics.rctl is None:
+            continue
+
+        for key, value in vm_metrics.rctl.items():
+            total.rctl[key] = total.rctl.get(key, 0) + value
+
+    return total
+
+# Adds the metrics to the recent samples, keeping the ones in the window and the
+# newest one before it (so there is a base even when the samples are far
+# apart), and returns the rates computed from them.
+def record_sample(metrics, window=DEFAULT_RATES_WINDOW, now=None):
+    if now is None:
+        now = time.time()
+
+    sample = {
+        "time" : now,
+        "counters" : {},
+        "gauges" : dict.fromkeys(RATES_GAUGES, 0)
+    }
+
+    for vm, vm_metrics in metrics.items():
+        sample["counters"][vm] = [getattr(vm_metrics, counter) for counter in RATES_COUNTERS]
+
+        if vm_metrics.rctl is None:
+            continue
+
+        for gauge in RATES_GAUGES:
+            sample["gauges"][gauge] += vm_metrics.rctl.get(gauge, 0)
+
+    with state.lock(RATES_FILE):
+        samples = state.load(RATES_FILE, [])
+
+        samples = [old for old in samples if old["time"] < now]
+        samples.append(sample)
+
+        start = now - window
+
+        while len(samples) > 2 and samples[1]["time"] <= start:
+            samples.pop(0)
+
+        samples = samples[-DEFAULT_RATES_SAMPLES:]
+
+        state.save(RATES_FILE, samples)
+
+    return compute_rates(samples)
+
+# The counters are per VM, so a VM that is created, destroyed or restarted does
+# not make the totals go backwards: a counter lower than in the previous sample
+# has been reset and its increase is the new value. A VM that is not in the
+# previous sample is skipped, its counters are totals since it was started.
+def compute_rates(samples):
+    if len(samples) < 2:
+        return None
+
+    elapsed = samples[-1]["time"] - samples[0]["time"]
+
+    if elapsed <= 0:
+        return None
+
+    rates = Rates()
+
+    increases = dict.fromkeys(RATES_COUNTERS, 0)
+
+    for (old, new) in zip(samples, samples[1:]):
+        for vm, counters in new["counters"].items():
+            old_counters = old["counters"].get(vm)
+
+            if old_counters is None:
+                continue
+
+            for index, counter in enumerate(RATES_COUNTERS):
+                increase = counters[index]
+
+                if counters[index] >= old_counters[index]:
+                    increase -= old_counters[index]
+
+                increases[counter] += increase
+
+    for counter in RATES_COUNTERS:
+        setattr(rates, counter, increases[counter] / elapsed)
+
+    # The rctl(8) rates are already per second, so they are just averaged.
+    for gauge in RATES_GAUGES:
+        setattr(rates, gauge, sum(sample["gauges"][gauge] for sample in samples[1:]) / (len(samples) - 1))
+
+    return rates
+
+# Returns {vm : {metric : new - old}} (the rctl(8) resources in 'rctl') for the
+# virtual machines and metrics present in both.
+def diff_metrics(old, new):
+    diff = {}
+
+    for vm, old_metrics in old.items():
+        if vm not in new:
+            continue
+
+        new_metrics = new[vm]
+
+        diff[vm] = {}
+
+        for metric, old_value in old_metrics.items():
+            if metric not in new_metrics:
+                continue
+
+            new_value = new_metrics[metric]
+
+            if metric == "rctl":
+                if old_value is None or new_value is None:
+                    continue
+
+                diff[vm][metric] = {
+                    key : new_value[key] - value for key, value in old_value.items() if key in new_value
+                }
+            else:
+                diff[vm][metric] = new_value - old_value
+
+    return diff
+
+# Encodes the metrics as the changes against 'old': the metrics that have
+# changed (the new virtual machines with all of them) and the virtual machines
+# that no longer exist. See apply_delta().
+def delta_metrics(old, new):
+    diff = diff_metrics(old, new)
+
+    changed = {}
+
+    for vm, new_metrics in new.items():
+        if vm not in old:
+            changed[vm] = new_metrics
+            continue
+
+        vm_delta = {}
+
+        for metric, value in new_metrics.items():
+            if metric not in diff[vm]:
+                # New metric or rctl(8) has become (un)available.
+                if value != old[vm].get(metric):
+                    vm_delta[metric] = value
+            elif metric == "rctl":
+                rctl_delta = {key : value for key, value in diff[vm][metric].items() if value != 0}
+
+                for key, value in new_metrics[metric].items():
+                    if key not in diff[vm][metric]:
+                        rctl_delta[key] = value
+
+                if rctl_delta:
+                    vm_delta[metric] = rctl_delta
+            elif diff[vm][metric] != 0:
+                vm_delta[metric] = diff[vm][metric]
+
+        if vm_delta:
+            changed[vm] = vm_delta
+
+    return {
+        "changed" : changed,
+        "removed" : sorted(vm for vm in old if vm not in new)
+    }
+
+def apply_delta(metrics, delta):
+    metrics = {
+        vm : dict(vm_metrics) for vm, vm_metrics in metrics.items() if vm not in delta["removed"]
+    }
+
+    for vm, vm_delta in delta["changed"].items():
+        if vm not in metrics:
+            metrics[vm] = vm_delta
+            continue
+
+        vm_metrics = metrics[vm]
+
+        for metric, value in vm_delta.items():
+            old_value = vm_metrics.get(metric)
+
+            if old_value is None or value is None:
+                vm_metrics[metric] = value
+            elif metric == "rctl":
+                rctl = dict(old_value)
+
+                for key, rctl_value in value.items():
+                    rctl[key] = rctl.get(key, 0) + rctl_value
+
+                vm_metrics[metric] = rctl
+            else:
+                vm_metrics[metric] = old_value + value
+
+    return metrics
+
+# Returns the report of the metrics: a full snapshot every 'full_every' reports
+# ('base' is None) and the delta against the last report otherwise. The report
+# becomes the base of the next one only after save_report().
+def get_report(metrics, full_every):
+    last = state.load(REPORT_FILE)
+
+    if last is None:
+        return {
+            "seq" : 1,
+            "base" : None,
+            "deltas" : 0,
+            "metrics" : metrics
+        }
+
+    if (last["deltas"] + 1) >= full_every:
+        return {
+            "seq" : last["seq"] + 1,
+            "base" : None,
+            "deltas" : 0,
+            "metrics" : metrics
+        }
+
+    return {
+        "seq" : last["seq"] + 1,
+        "base" : last["seq"],
+        "deltas" : last["deltas"] + 1,
+        "metrics" : delta_metrics(last["metrics"], metrics)
+    }
+
+def save_report(report, metrics):
+    state.save(REPORT_FILE, {
+        "seq" : report["seq"],
+        "deltas" : report["deltas"],
+        "metrics" : metrics
+    })
+
+def probe(func, items, jobs=DEFAULT_JOBS):
+    if not items:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(jobs, len(items))) as executor:
+        results = executor.map(func, items)
+
+        return list(zip(items, results))
+
+def parse_limits(vm_info):
+    limits = Limits()
+
+    for (key, value) in vm_info:
+        if key == "memory":
+            limits.memory = parse_size(value.split(" ", 1)[0], binary=True)
+        elif key == "bytes-size":
+            limits.storage += int(value.split(" ", 1)[0])
+
+    return limits
+
+def parse_metrics(vm_info):
+    metrics = Metrics()
+
+    for (key, value) in vm_info:
+        if key == "memory-resident":
+            metrics.memory_usage = int(value.split(" ", 1)[0])
+        elif key == "bytes-in":
+            metrics.rx += int(value.split(" ", 1)[0])
+        elif key == "bytes-out":
+            metrics.tx += int(value.split(" ", 1)[0])
+        elif key == "bytes-used":
+            metrics.storage_usage += int(value.split(" ", 1)[0])
+
+    return metrics
+
+def get_vm_info(vm):
+    process = get_output("vm", "info", vm)
+
+    if process.stdout == "":
+        return None
+
+    vm_info = []
+
+    for line in process.stdout.splitlines():
+        match = re.search(r"^[^:]+: .+$", line.strip())
+
+        if not match:
+            continue
+
+        (key, value) = match.group(0).split(":", 1)
+
+        vm_info.append((key.strip(), value.strip()))
+
+    return vm_info
+
+def get_rctl(pid):
+    rctl = get_output("rctl", "-u", f"process:{pid}")
+
+    if rctl.stdout == "":
+        return None
+
+    rctl_metrics = {}
+
+    for line in rctl.stdout.splitlines():
+        (key, value) = line.split("=", 1)
+
+        rctl_metrics[key] = int(value)
+
+    return rctl_metrics
+
+def get_running_machines():
+    process = get_output("pgrep", "-fl", "^bhyve: vm[0-9][0-9][0-9]$")
+
+    running = {}
+
+    for line in process.stdout.splitlines():
+        match = re.search(r"^([0-9]+) .*(vm[0-9][0-9][0-9])$", line)
+
+        if not match:
+            continue
+
+        running[match.group(2)] = int(match.group(1))
+
+    return running
+
+def get_vm_machines(vm_bhyve_dir):
+    if not os.path.isdir(vm_bhyve_dir):
+        return
+
+    for entry in sorted(os.scandir(vm_bhyve_dir), key=lambda e: e.name):
+        if not re.search(r"^vm[0-9][0-9][0-9]$", entry.name):
+            continue
+
+        if entry.name == "vm000" or entry.name == "vm999":
+            continue
+
+        if entry.is_dir():
+            yield entry.name
+
+def get_vm_dir():
+    process = get_output("sysrc", "-ni", "vm_dir")
+
+    if process.stdout == "":
+        return None
+
+    return process.stdout.rstrip()
+
+def get_output(*args):
+    return subprocess.run(args, stdout=subprocess.PIPE, text=True)
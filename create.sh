@@ -32,6 +32,8 @@ main()
     local swap="${SWAP:-4G}"
     local chroot_script="${CHROOT_SCRIPT:-${BASEDIR}/local.sh}"
     local resolv_conf="${RESOLV_CONF:-/etc/resolv.conf}"
+    local golden="${GOLDEN:-false}"
+    local stage="${CREATE_STAGE:-all}"
 
     handle_signals
 
@@ -43,8 +45,11 @@ main()
         exit ${EX_NOINPUT}
     fi
 
-    while getopts ":c:C:d:m:p:P:r:s:S:t:" _o; do
+    while getopts ":bc:C:d:gm:p:P:r:s:S:t:u" _o; do
         case "${_o}" in
+            b)
+                stage="base"
+                ;;
             c)
                 components="${OPTARG}"
                 ;;
@@ -54,6 +59,9 @@ main()
             d)
                 domain="${OPTARG}"
                 ;;
+            g)
+                golden=true
+                ;;
             m)
                 mntdir="${OPTARG}"
                 ;;
@@ -75,6 +83,9 @@ main()
             t)
                 template="${OPTARG}"
                 ;;
+            u)
+                stage="custom"
+                ;;
             *)
                 usage
                 exit ${EX_USAGE}
@@ -93,6 +104,38 @@ main()
     
     shift
 
+    # The base stage builds the root partition of a new VM and the custom
+    # stage applies the per-VM customization to an existing one. See deploy.sh.
+    local build_base
+    local customize
+
+    case "${stage}" in
+        all)
+            build_base=true
+            customize=true
+            ;;
+        base)
+            build_base=true
+            customize=false
+            ;;
+        custom)
+            build_base=false
+            customize=true
+            ;;
+        *)
+            err "Invalid stage '${stage}'"
+            exit ${EX_USAGE}
+            ;;
+    esac
+
+    local create_vm
+    create_vm="${build_base}"
+
+    # The golden image has already been built.
+    if ${golden}; then
+        build_base=false
+    fi
+
     swap=`tobytes "${swap}"`
     size=`tobytes "${size}"`
     
@@ -102,22 +145,61 @@ main()
     local rootpart_size
     rootpart_size=$((size-swap))
 
-    info "Creating VM '${name}'"
-
     local vm_dir
     vm_dir="${vm_bhyve_dir}/${name}"
 
+    if ! ${create_vm} && [ ! -d "${vm_dir}" ]; then
+        err "VM '${name}' cannot be found"
+        exit ${EX_NOINPUT}
+    fi
+
     GLOBAL_VM_DIR="${vm_dir}"
     GLOBAL_VM_NAME="${name}"
 
-    vm create \
-        -t "${template}" \
-        -s $((size+pad)) \
-            "${name}" || exit $?
+    # See timing_begin() in lib.subr. The custom stage of a pooled VM appends
+    # its phases to the ones of the base stage.
+    TIMING_FILE="${vm_dir}/.timings"
 
     local vm_disk0
     vm_disk0="${vm_dir}/disk0.img"
 
+    if ${create_vm}; then
+        info "Creating VM '${name}'"
+
+        timing_begin "creating"
+
+        vm create \
+            -t "${template}" \
+            -s $((size+pad)) \
+                "${name}" || exit $?
+
+        timing_end
+    else
+        info "Customizing VM '${name}'"
+    fi
+
+    if ${create_vm} && ${golden}; then
+        timing_begin "golden"
+
+        local golden_image
+        golden_image=`"${BASEDIR}/golden.sh" \
+            -c "${components}" \
+            -m "${mntdir}" \
+            -r "${resolv_conf}" \
+            -s "${size}" \
+            -S "${swap}"` || exit $?
+
+        info "Cloning golden image '${golden_image}'"
+
+        timing_begin "cloning"
+
+        # cp(1) uses copy_file_range(2), so the blocks are cloned when the
+        # file system supports it and the holes are preserved otherwise.
+        cp "${golden_image}" "${vm_disk0}" || exit $?
+
+        timing_end `stat -f %z "${vm_disk0}"`
+    fi
+
     local md_device
     md_device=`mdconfig -at vnode -f "${vm_disk0}"` || exit $?
 
@@ -125,20 +207,28 @@ main()
 
     info "md(4) device is '${md_device}'"
 
-    info "Partitioning"
-
-    gpart create -s gpt "${md_device}" || exit $?
-    gpart add -a 1m -t freebsd-boot -s 512k "${md_device}" || exit $?
-    gpart add -a 1m -t freebsd-swap -s "${swap}b" "${md_device}" || exit $?
-    gpart add -a 1m -t freebsd-ufs -s "${rootpart_size}b" "${md_device}" || exit $?
-    gpart bootcode -b /boot/pmbr -p /boot/gptboot -i 1 "${md_device}" || exit $?
-
     local rootpart
     rootpart="/dev/${md_device}p3"
 
-    info "Formatting"
+    if ${build_base}; then
+        info "Partitioning"
+
+        timing_begin "partitioning"
+
+        gpart create -s gpt "${md_device}" || exit $?
+        gpart add -a 1m -t freebsd-boot -s 512k "${md_device}" || exit $?
+        gpart add -a 1m -t freebsd-swap -s "${swap}b" "${md_device}" || exit $?
+        gpart add -a 1m -t freebsd-ufs -s "${rootpart_size}b" "${md_device}" || exit $?
+        gpart bootcode -b /boot/pmbr -p /boot/gptboot -i 1 "${md_device}" || exit $?
+
+        info "Formatting"
+
+        timing_begin "formatting"
 
-    newfs -U "${rootpart}" || exit $?
+        newfs -U "${rootpart}" || exit $?
+
+        timing_end
+    fi
 
     local vm_mntdir
     vm_mntdir="${mntdir}/${name}"
@@ -153,32 +243,51 @@ main()
 
     GLOBAL_VM_MNTDIR_MOUNTED=true
 
-    local component
-    for component in ${components}; do
-        info "Extracting component '${component}'"
+    # Used to know how many bytes each phase writes.
+    local used
 
-        local component_file
-        component_file="${BASEDIR}/components/${component}"
+    # The golden image already has the components, fstab(5), files/, the
+    # packages and the patches.
+    if ${build_base}; then
+        used=`used_bytes "${vm_mntdir}"`
 
-        if [ ! -f "${component_file}" ]; then
-            err "Component '${component}' cannot be found"
-            exit ${EX_NOINPUT}
-        fi
+        timing_begin "extracting"
 
-        tar -C "${vm_mntdir}" -xf "${component_file}" || exit $?
-    done
+        local component
+        for component in ${components}; do
+            info "Extracting component '${component}'"
+
+            local component_file
+            component_file="${BASEDIR}/components/${component}"
+
+            if [ ! -f "${component_file}" ]; then
+                err "Component '${component}' cannot be found"
+                exit ${EX_NOINPUT}
+            fi
+
+            tar -C "${vm_mntdir}" -xf "${component_file}" || exit $?
+        done
 
-    info "Writing fstab(5)"
+        timing_end $((`used_bytes "${vm_mntdir}"`-used))
 
-    cat << "EOF" > "${vm_mntdir}/etc/fstab"
+        info "Writing fstab(5)"
+
+        cat << "EOF" > "${vm_mntdir}/etc/fstab"
 /dev/nda0p3        /           ufs         rw        1        1
 /dev/nda0p2        none        swap        sw        0        0
 EOF
 
-    if [ -d "${BASEDIR}/files" ]; then
-        info "Copying ${BASEDIR}/files/ to ${vm_mntdir}"
+        if [ -d "${BASEDIR}/files" ]; then
+            info "Copying ${BASEDIR}/files/ to ${vm_mntdir}"
+
+            used=`used_bytes "${vm_mntdir}"`
+
+            timing_begin "files"
+
+            cp -va "${BASEDIR}/files/" "${vm_mntdir}" || exit $?
 
-        cp -va "${BASEDIR}/files/" "${vm_mntdir}" || exit $?
+            timing_end $((`used_bytes "${vm_mntdir}"`-used))
+        fi
     fi
 
     if [ -f "${vm_mntdir}/etc/resolv.conf" ]; then
@@ -203,50 +312,67 @@ EOF
             "208.67.222.222" "208.67.220.220" > "${vm_mntdir}/etc/resolv.conf" || exit $?
     fi
 
-    if [ -f "${BASEDIR}/pkg.lst" ]; then
+    if ${build_base} && [ -f "${BASEDIR}/pkg.lst" ]; then
         info "Installing packages"
 
-        pkg -c "${vm_mntdir}" install -y -- `cat "${BASEDIR}/pkg.lst"` || exit $?
+        used=`used_bytes "${vm_mntdir}"`
+
+        timing_begin "pkg"
+
+        "${BASEDIR}/fetch-cache.sh" pkg-install "${vm_mntdir}" `cat "${BASEDIR}/pkg.lst"` || exit $?
+
+        timing_end $((`used_bytes "${vm_mntdir}"`-used))
     fi
 
-    info "Configuring hostname"
+    if ${customize}; then
+        info "Configuring hostname"
 
-    echo >> "${vm_mntdir}/etc/rc.conf"
-    echo "# HOSTNAME" >> "${vm_mntdir}/etc/rc.conf"
-    sysrc -R "${vm_mntdir}" hostname="${name}${domain}" || exit $?
+        timing_begin "customizing"
 
-    if [ -x "${pre_script}" ]; then
-        info "Executing ${pre_script}"
+        echo >> "${vm_mntdir}/etc/rc.conf"
+        echo "# HOSTNAME" >> "${vm_mntdir}/etc/rc.conf"
+        sysrc -R "${vm_mntdir}" hostname="${name}${domain}" || exit $?
 
-        (cd "${vm_mntdir}"; VMNAME="${name}" WRKDIR="${BASEDIR}" "${pre_script}" "$@") || exit $?
-    fi
+        if [ -x "${pre_script}" ]; then
+            info "Executing ${pre_script}"
+
+            (cd "${vm_mntdir}"; VMNAME="${name}" WRKDIR="${BASEDIR}" "${pre_script}" "$@") || exit $?
+        fi
 
-    if [ -x "${chroot_script}" ]; then
-        info "Copying ${chroot_script} as ${vm_mntdir}/local.sh"
+        if [ -x "${chroot_script}" ]; then
+            info "Copying ${chroot_script} as ${vm_mntdir}/local.sh"
 
-        cp -va "${chroot_script}" "${vm_mntdir}/local.sh" || exit $?
+            cp -va "${chroot_script}" "${vm_mntdir}/local.sh" || exit $?
 
-        info "Executing local.sh"
-        
-        chroot "${vm_mntdir}" /local.sh "$@" || exit $?
-        chroot "${vm_mntdir}" rm -f /local.sh || exit $?
+            info "Executing local.sh"
+            
+            chroot "${vm_mntdir}" /local.sh "$@" || exit $?
+            chroot "${vm_mntdir}" rm -f /local.sh || exit $?
+        fi
+
+        timing_end
     fi
 
-    local freebsd_version
-    freebsd_version=`chroot "${vm_mntdir}" freebsd-version | sed -Ee 's/\-p[0-9]+$//'` || exit $?
+    if ${build_base}; then
+        info "Updating"
+
+        used=`used_bytes "${vm_mntdir}"`
 
-    info "Updating"
+        timing_begin "freebsd-update"
 
-    env PAGER=cat freebsd-update \
-        --not-running-from-cron \
-        -b "${vm_mntdir}" \
-        --currently-running "${freebsd_version}" \
-            fetch install || exit $?
+        "${BASEDIR}/fetch-cache.sh" freebsd-update "${vm_mntdir}" || exit $?
 
-    if [ -x "${post_script}" ]; then
+        timing_end $((`used_bytes "${vm_mntdir}"`-used))
+    fi
+
+    if ${customize} && [ -x "${post_script}" ]; then
         info "Executing ${post_script}"
 
+        timing_begin "post"
+
         (cd "${vm_mntdir}"; VMNAME="${name}" WRKDIR="${BASEDIR}" "${post_script}" "$@") || exit $?
+
+        timing_end
     fi
 
     if [ -f "${vm_mntdir}/etc/resolv.conf.bak" ]; then
@@ -269,9 +395,12 @@ EOF
 
     mdconfig -du "${md_device}" || exit $?
 
-    info "VM '${name}' will be started using 'vm startall' or 'vm start ${name}'"
+    if ${customize}; then
+        info "VM '${name}' will be started using 'vm startall' or 'vm start ${name}'"
 
-    sysrc vm_list+="${name}" || exit $?
+        lockf -k "${BASEDIR}/.rc.lock" \
+            sysrc vm_list+="${name}" || exit $?
+    fi
 
     GLOBAL_ERROR=false
 
@@ -322,12 +451,17 @@ cleanup()
         vm destroy -f "${GLOBAL_VM_NAME}"
     fi
 
+    # pre.sh may have already indexed the tags. See tagindex.py.
+    if [ -n "${GLOBAL_VM_NAME}" ]; then
+        "${BASEDIR}/tagindex.py" remove "${GLOBAL_VM_NAME}"
+    fi
+
     restore_signals
 }
 
 usage()
 {
-    echo "create.sh [-c <components>] [-C <script>] [-d <domain>] [-p <script>]"
+    echo "create.sh [-b|-u] [-g] [-c <components>] [-C <script>] [-d <domain>] [-p <script>]"
     echo "          [-P <script>] [-m <mount-directory>] [-r <file>] [-s <size>]"
     echo "          [-S <swap-size>] [-t <template>] <name>"
 }
@@ -5,8 +5,35 @@ BASEDIR=`realpath -- "${BASEDIR}"` || exit $?
 
 . "${BASEDIR}/lib.subr"
 
+# Globals
+GLOBAL_VM_CLAIM=
+GLOBAL_VM_NAME=
+GLOBAL_VM_DIR=
+GLOBAL_ERROR=true
+
+# Signals
+SIGNALS_IGNORED="SIGALRM SIGVTALRM SIGPROF SIGUSR1 SIGUSR2"
+SIGNALS_HANDLED="SIGHUP SIGINT SIGQUIT SIGTERM SIGXCPU SIGXFSZ"
+
 main()
 {
+    local _o
+    # options
+    local pool=false
+
+    while getopts ":p" _o; do
+        case "${_o}" in
+            p)
+                pool=true
+                ;;
+            *)
+                usage
+                exit ${EX_USAGE}
+                ;;
+        esac
+    done
+    shift $((OPTIND-1))
+
     if [ $# -lt 1 ]; then
         usage
         exit ${EX_USAGE}
@@ -20,12 +47,46 @@ main()
         exit ${EX_NOINPUT}
     fi
 
-    local next_id
-    next_id=1
+    handle_signals
+
+    local profile
+    profile="$1"
+
+    shift
+
+    local alloc_dir
+    alloc_dir="${BASEDIR}/.alloc"
+
+    if [ ! -d "${alloc_dir}" ]; then
+        mkdir -p "${alloc_dir}" || exit $?
+    fi
+
+    local pool_dir
+    pool_dir="${BASEDIR}/pool/${profile}"
 
     local vm_name=
+    local stage="all"
+
+    if ${pool}; then
+        stage="base"
+    elif [ -d "${pool_dir}" ]; then
+        local pooled_vm
+        for pooled_vm in `ls -- "${pool_dir}"`; do
+            # rmdir(1) is atomic, so only one deploy.sh can claim a pooled VM.
+            if rmdir "${pool_dir}/${pooled_vm}" 2> /dev/null; then
+                info "Using pooled VM '${pooled_vm}'"
+
+                vm_name="${pooled_vm}"
+                stage="custom"
+                break
+            fi
+        done
+    fi
 
-    while :; do
+    local next_id
+    next_id=1
+
+    while [ -z "${vm_name}" ]; do
         if [ ${next_id} -ge 999 ]; then
             err "The maximum allocation has been made."
             exit ${EX_NOPERM}
@@ -35,17 +96,39 @@ main()
         next_name=`printf "vm%003d" "${next_id}"`
 
         if [ ! -d "${vm_bhyve_dir}/${next_name}" ]; then
-            vm_name="${next_name}"
-            break
+            release_stale_claim "${alloc_dir}/${next_name}"
+        fi
+
+        # mkdir(1) is atomic, so only one deploy.sh can claim a name.
+        if [ ! -d "${vm_bhyve_dir}/${next_name}" ] && \
+                mkdir "${alloc_dir}/${next_name}" 2> /dev/null; then
+            GLOBAL_VM_CLAIM="${alloc_dir}/${next_name}"
+
+            echo $$ > "${GLOBAL_VM_CLAIM}/pid" || exit $?
+
+            # Another process may have created and released this VM between
+            # the check and the claim.
+            if [ ! -d "${vm_bhyve_dir}/${next_name}" ]; then
+                vm_name="${next_name}"
+                break
+            fi
+
+            rm -rf "${GLOBAL_VM_CLAIM}"
+
+            GLOBAL_VM_CLAIM=
         fi
 
         next_id=$((next_id+1))
     done
 
-    local profile
-    profile="$1"
+    GLOBAL_VM_NAME="${vm_name}"
+    GLOBAL_VM_DIR="${vm_bhyve_dir}/${vm_name}"
 
-    shift
+    # A previous VM with the same name may have left its tags in the index,
+    # and a pooled VM has no tags until it is used. See tagindex.py.
+    if [ "${stage}" != "custom" ]; then
+        "${BASEDIR}/tagindex.py" remove "${vm_name}" || exit $?
+    fi
 
     if [ ! -d "${BASEDIR}/dirty" ]; then
         mkdir -p "${BASEDIR}/dirty" || exit $?
@@ -53,21 +136,128 @@ main()
 
     touch "${BASEDIR}/dirty/${vm_name}" || exit $?
 
-    "${BASEDIR}/profiles/${profile}.sh" \
-        "${vm_name}" "$@" || exit $?
+    env CREATE_STAGE="${stage}" \
+        "${BASEDIR}/profiles/${profile}.sh" \
+            "${vm_name}" "$@" || exit $?
 
-    info "Starting VM '${vm_name}'"
+    if ${pool}; then
+        info "Adding VM '${vm_name}' to the pool '${profile}'"
+
+        if [ ! -d "${pool_dir}" ]; then
+            mkdir -p "${pool_dir}" || exit $?
+        fi
 
-    vm start "${vm_name}" || exit $?
+        mkdir "${pool_dir}/${vm_name}" || exit $?
+    else
+        info "Starting VM '${vm_name}'"
+
+        # See create.sh.
+        TIMING_FILE="${GLOBAL_VM_DIR}/.timings"
+
+        timing_begin "starting"
+
+        vm start "${vm_name}" || exit $?
+
+        timing_end
+    fi
 
     rm -f "${BASEDIR}/dirty/${vm_name}" || exit $?
 
+    GLOBAL_ERROR=false
+
     return ${EX_OK}
 }
 
+# A claim is released by cleanup(), which is not run when deploy.sh is killed
+# (e.g. by timeout.sh), so the claim of a process that no longer exists is
+# released here.
+release_stale_claim()
+{
+    local claim
+    claim="$1"
+
+    if [ ! -d "${claim}" ]; then
+        return 0
+    fi
+
+    local pid
+    pid=`cat "${claim}/pid" 2> /dev/null`
+
+    if [ -z "${pid}" ]; then
+        # The owner is writing its PID, unless the claim is older than that
+        # (or has been made by an older deploy.sh).
+        if [ -z "`find "${claim}" -prune -mmin +1`" ]; then
+            return 0
+        fi
+    elif kill -0 "${pid}" 2> /dev/null; then
+        return 0
+    fi
+
+    # Only one process releases it. The PID is read again, because the
+    # claim may have been released and claimed again in the meantime.
+    mkdir "${claim}/release" 2> /dev/null || return 0
+
+    if [ "`cat "${claim}/pid" 2> /dev/null`" = "${pid}" ]; then
+        warn "Releasing the stale claim of '${claim##*/}'"
+
+        rm -rf "${claim}"
+    else
+        rmdir "${claim}/release"
+    fi
+}
+
+handle_signals()
+{
+    trap '' ${SIGNALS_IGNORED}
+    trap "_ERRLEVEL=\$?; cleanup; exit \${_ERRLEVEL}" EXIT
+    trap "cleanup; exit 70" ${SIGNALS_HANDLED}
+}
+
+ignore_all_signals()
+{
+    trap '' ${SIGNALS_HANDLED} EXIT
+}
+
+restore_signals()
+{
+    trap - ${SIGNALS_HANDLED} ${SIGNALS_IGNORED} EXIT
+}
+
+cleanup()
+{
+    ignore_all_signals
+
+    if [ -n "${GLOBAL_VM_CLAIM}" ] && [ -d "${GLOBAL_VM_CLAIM}" ]; then
+        rm -rf "${GLOBAL_VM_CLAIM}"
+    fi
+
+    # The VM may exist even if something failed (e.g. 'vm start').
+    if [ -n "${GLOBAL_VM_DIR}" ] && [ -d "${GLOBAL_VM_DIR}" ]; then
+        if ! "${BASEDIR}/ledger.py" add "${GLOBAL_VM_NAME}"; then
+            warn "Could not add '${GLOBAL_VM_NAME}' to the ledger"
+        fi
+    elif ${GLOBAL_ERROR} && [ -n "${GLOBAL_VM_NAME}" ]; then
+        # Destroyed by create.sh, so the name can be reused. A pooled VM was
+        # already in the ledger.
+        if ! "${BASEDIR}/ledger.py" remove "${GLOBAL_VM_NAME}"; then
+            warn "Could not remove '${GLOBAL_VM_NAME}' from the ledger"
+        fi
+
+        if ! "${BASEDIR}/tagindex.py" remove "${GLOBAL_VM_NAME}"; then
+            warn "Could not remove '${GLOBAL_VM_NAME}' from the tag index"
+        fi
+    fi
+
+    # See collector.py.
+    lockf -k "${BASEDIR}/.capacity.json.lock" \
+        rm -f "${BASEDIR}/.capacity.json"
+
+    restore_signals
+}
+
 usage()
 {
-    echo "deploy.sh <profile-name> [<args> ...]"
+    echo "deploy.sh [-p] <profile-name> [<args> ...]"
 }
 
 main "$@"
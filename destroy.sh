@@ -34,9 +34,29 @@ main()
         sleep 1
     fi
 
-    vm destroy -f "${vm}" || exit $?
+    # DESTROY_LOCK is used by 'cluster.py' to limit how many VMs are
+    # removed from the disk at the same time.
+    if [ -n "${DESTROY_LOCK}" ]; then
+        lockf -k "${DESTROY_LOCK}" \
+            vm destroy -f "${vm}" || exit $?
+    else
+        vm destroy -f "${vm}" || exit $?
+    fi
+
+    if ! "${BASEDIR}/ledger.py" remove "${vm}"; then
+        warn "Could not remove '${vm}' from the ledger"
+    fi
+
+    if ! "${BASEDIR}/tagindex.py" remove "${vm}"; then
+        warn "Could not remove '${vm}' from the tag index"
+    fi
+
+    # See collector.py.
+    lockf -k "${BASEDIR}/.capacity.json.lock" \
+        rm -f "${BASEDIR}/.capacity.json"
 
-    sysrc "vm_list-=${vm}" || exit $?
+    lockf -k "${BASEDIR}/.rc.lock" \
+        sysrc "vm_list-=${vm}" || exit $?
 
     exit ${EX_OK}
 }
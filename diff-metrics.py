@@ -2,9 +2,10 @@
 
 import json
 import os
-import subprocess
 import sys
 
+import collector
+
 BASEDIR = os.path.join(".", os.path.dirname(sys.argv[0]))
 BASEDIR = os.path.realpath(BASEDIR)
 
@@ -40,43 +41,22 @@ def main(*args):
     with open(a_metrics_file) as fd:
         a_metrics = json.loads(fd.read())
 
-    process = get_output(f"{BASEDIR}/get-metrics.py")
-
-    if process.stdout == "":
-        return EX_SOFTWARE
-
-    b_metrics = json.loads(process.stdout)
-
-    diff_metrics = {}
-
-    for vm, metrics in a_metrics.items():
-        if vm not in b_metrics:
-            continue
+    b_metrics = collector.collect_metrics()
+    b_metrics = { vm : vm_metrics.todict() for vm, vm_metrics in b_metrics.items() }
 
-        diff_metrics[vm] = {}
+    diff_metrics = collector.diff_metrics(a_metrics, b_metrics)
 
-        for metric in metrics:
-            if metric not in b_metrics[vm]:
-                continue
-
-            if metric == "rctl" and isinstance(metrics[metric], dict):
-                diff_metrics[vm][metric] = {}
-
-                for rctl_key, rctl_value in metrics[metric].items():
-                    if rctl_key not in b_metrics[vm][metric]:
-                        continue
-
-                    diff_metrics[vm][metric][rctl_key] = abs(metrics[metric][rctl_key]-b_metrics[vm][metric][rctl_key])
+    for vm_metrics in diff_metrics.values():
+        for metric, value in vm_metrics.items():
+            if metric == "rctl":
+                vm_metrics[metric] = { rctl_key : abs(rctl_value) for rctl_key, rctl_value in value.items() }
             else:
-                diff_metrics[vm][metric] = abs(metrics[metric]-b_metrics[vm][metric])
+                vm_metrics[metric] = abs(value)
 
     print(json.dumps(diff_metrics, indent=4))
 
     return EX_OK
 
-def get_output(*args):
-    return subprocess.run(args, stdout=subprocess.PIPE, text=True)
-
 def warn(msg):
     print(f"##!> {msg} <!##", file=sys.stderr)
 
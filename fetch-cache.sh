@@ -0,0 +1,491 @@
+#!/bin/sh
+
+BASEDIR=`dirname -- "$0"` || exit $?
+BASEDIR=`realpath -- "${BASEDIR}"` || exit $?
+
+. "${BASEDIR}/lib.subr"
+. "${BASEDIR}/config.conf"
+
+# Global
+GLOBAL_NULLFS_MNTDIR=
+
+# Signals
+SIGNALS_IGNORED="SIGALRM SIGVTALRM SIGPROF SIGUSR1 SIGUSR2"
+SIGNALS_HANDLED="SIGHUP SIGINT SIGQUIT SIGTERM SIGXCPU SIGXFSZ"
+
+main()
+{
+    if [ $# -lt 1 ]; then
+        usage
+        exit ${EX_USAGE}
+    fi
+
+    local cmd
+    cmd="$1"
+
+    shift
+
+    local cachedir
+    cachedir="${FETCH_CACHEDIR:-${BASEDIR}/cache}"
+
+    if [ ! -d "${cachedir}" ]; then
+        mkdir -p "${cachedir}" || exit $?
+    fi
+
+    case "${cmd}" in
+        pkg-install)
+            pkg_install "${cachedir}" "$@"
+            ;;
+        freebsd-update)
+            freebsd_update "${cachedir}" "$@"
+            ;;
+        refresh)
+            refresh "${cachedir}" "$@"
+            ;;
+        stats)
+            stats "${cachedir}" "$@"
+            ;;
+        clean)
+            clean "${cachedir}" "$@"
+            ;;
+        -f)
+            # Used internally to download while holding the lock.
+            locked_fetch "${cachedir}" "$@"
+            ;;
+        *)
+            usage
+            exit ${EX_USAGE}
+            ;;
+    esac
+}
+
+pkg_install()
+{
+    local cachedir
+    cachedir="$1"
+
+    shift
+
+    if [ $# -lt 1 ]; then
+        usage
+        exit ${EX_USAGE}
+    fi
+
+    local mntdir
+    mntdir="$1"
+
+    shift
+
+    if [ $# -eq 0 ]; then
+        return ${EX_OK}
+    fi
+
+    handle_signals
+
+    local pkg_cachedir
+    pkg_cachedir="${cachedir}/pkg"
+
+    mkdir -p "${pkg_cachedir}" "${mntdir}/var/cache/pkg" || exit $?
+
+    info "Mounting ${pkg_cachedir} in ${mntdir}/var/cache/pkg"
+
+    mount -t nullfs "${pkg_cachedir}" "${mntdir}/var/cache/pkg" || exit $?
+
+    GLOBAL_NULLFS_MNTDIR="${mntdir}/var/cache/pkg"
+
+    # Only one process downloads to the cache at a time, so the same package
+    # is never downloaded twice. The installation only reads from it. The
+    # catalogue is also shared: it is copied to the chroot while holding the
+    # lock, so pkg(8) runs with REPO_AUTOUPDATE=false.
+    info "Fetching packages"
+
+    local misses
+    misses=`lockf -k "${cachedir}/.pkg.lock" "$0" -f pkg "${mntdir}" "$@"` || exit $?
+
+    info "Installing packages"
+
+    pkg -c "${mntdir}" -o REPO_AUTOUPDATE=false install -y -- "$@" || exit $?
+
+    local installed
+    installed=`pkg -c "${mntdir}" info -q | wc -l` || exit $?
+
+    local hits
+    hits=$((installed-misses))
+
+    if [ ${hits} -lt 0 ]; then
+        hits=0
+    fi
+
+    info "Package cache: ${hits} hits, ${misses} misses"
+
+    add_stats "${cachedir}" pkg ${hits} ${misses}
+
+    umount "${GLOBAL_NULLFS_MNTDIR}" || exit $?
+
+    GLOBAL_NULLFS_MNTDIR=
+
+    return ${EX_OK}
+}
+
+freebsd_update()
+{
+    local cachedir
+    cachedir="$1"
+
+    shift
+
+    if [ $# -lt 1 ]; then
+        usage
+        exit ${EX_USAGE}
+    fi
+
+    local basedir
+    basedir="$1"
+
+    # freebsd-update(8) shares its working directory between all VMs, so the
+    # patches are downloaded only once. Only the download is serialized: the
+    # installation only reads from the cache.
+    local misses
+    misses=`lockf -k "${cachedir}/.freebsd-update.lock" "$0" -f freebsd-update "${basedir}"` || exit $?
+
+    local freebsd_version
+    freebsd_version=`get_freebsd_version "${basedir}"` || exit $?
+
+    local errlevel=0
+
+    env PAGER=cat freebsd-update \
+        --not-running-from-cron \
+        -b "${basedir}" \
+        -d "${cachedir}/freebsd-update" \
+        --currently-running "${freebsd_version}" \
+            install || errlevel=$?
+
+    # 2 means that there are no updates to install.
+    if [ ${errlevel} -ne 0 ] && [ ${errlevel} -ne 2 ]; then
+        exit ${errlevel}
+    fi
+
+    local hits
+    if [ ${misses} -eq 0 ]; then
+        hits=1
+    else
+        hits=0
+    fi
+
+    info "freebsd-update(8) cache: ${misses} files downloaded"
+
+    add_stats "${cachedir}" freebsd-update ${hits} ${misses}
+
+    return ${EX_OK}
+}
+
+refresh()
+{
+    local cachedir
+    cachedir="$1"
+
+    shift
+
+    local _o
+    # options
+    local abi=
+
+    while getopts ":A:" _o; do
+        case "${_o}" in
+            A)
+                abi="${OPTARG}"
+                ;;
+            *)
+                usage
+                exit ${EX_USAGE}
+                ;;
+        esac
+    done
+    shift $((OPTIND-1))
+
+    if [ ! -f "${BASEDIR}/pkg.lst" ]; then
+        info "Nothing to refresh"
+        return ${EX_OK}
+    fi
+
+    if [ -z "${abi}" ]; then
+        abi=`pkg config ABI` || exit $?
+    fi
+
+    local pkg_cachedir
+    pkg_cachedir="${cachedir}/pkg"
+
+    local pkg_dbdir
+    pkg_dbdir="${cachedir}/pkgdb/${abi}"
+
+    mkdir -p "${pkg_cachedir}" "${pkg_dbdir}" || exit $?
+
+    info "Fetching packages (ABI:${abi})"
+
+    # The catalogue is updated before fetching and then used by pkg-install.
+    lockf -k "${cachedir}/.pkg.lock" \
+        pkg \
+            -o ABI="${abi}" \
+            -o PKG_CACHEDIR="${pkg_cachedir}" \
+            -o PKG_DBDIR="${pkg_dbdir}" \
+            `get_repos_args` \
+                fetch -y -d -- `cat "${BASEDIR}/pkg.lst"` || exit $?
+
+    touch "${pkg_dbdir}/.updated" || exit $?
+
+    return ${EX_OK}
+}
+
+stats()
+{
+    local cachedir
+    cachedir="$1"
+
+    local stats_file
+    stats_file="${cachedir}/stats"
+
+    if [ ! -f "${stats_file}" ]; then
+        return ${EX_OK}
+    fi
+
+    awk '
+        {
+            hits[$2] += $3
+            misses[$2] += $4
+            runs[$2]++
+        }
+        END {
+            if ("pkg" in runs) {
+                total = hits["pkg"] + misses["pkg"]
+
+                printf "pkg: %d runs, %d hits, %d misses, %.2f%% hit ratio\n", \
+                    runs["pkg"], hits["pkg"], misses["pkg"], total > 0 ? hits["pkg"] * 100 / total : 0
+            }
+
+            if ("freebsd-update" in runs) {
+                printf "freebsd-update: %d runs, %d served from the cache, %d files downloaded\n", \
+                    runs["freebsd-update"], hits["freebsd-update"], misses["freebsd-update"]
+            }
+        }
+    ' "${stats_file}"
+}
+
+clean()
+{
+    local cachedir
+    cachedir="$1"
+
+    info "Removing cached packages"
+
+    lockf -k "${cachedir}/.pkg.lock" \
+        rm -rf "${cachedir}/pkg" "${cachedir}/pkgdb" || exit $?
+
+    info "Removing freebsd-update(8) files"
+
+    lockf -k "${cachedir}/.freebsd-update.lock" \
+        rm -rf "${cachedir}/freebsd-update" || exit $?
+
+    rm -f "${cachedir}/stats" || exit $?
+
+    return ${EX_OK}
+}
+
+# Prints the number of files downloaded to the cache.
+locked_fetch()
+{
+    local cachedir
+    cachedir="$1"
+
+    local kind
+    kind="$2"
+
+    shift 2
+
+    local directory
+    local count_dir
+    local pattern
+
+    case "${kind}" in
+        pkg)
+            directory="${cachedir}/pkg"
+            count_dir="${directory}"
+            pattern="*.pkg"
+            ;;
+        freebsd-update)
+            directory="${cachedir}/freebsd-update"
+            count_dir="${directory}/files"
+            pattern="*"
+            ;;
+        *)
+            usage
+            exit ${EX_USAGE}
+            ;;
+    esac
+
+    if [ ! -d "${directory}" ]; then
+        mkdir -p "${directory}" || exit $?
+    fi
+
+    local before
+    before=`count_files "${count_dir}" "${pattern}"`
+
+    if [ "${kind}" = "pkg" ]; then
+        local mntdir
+        mntdir="$1"
+
+        shift
+
+        local abi
+        abi=`pkg -c "${mntdir}" config ABI` || exit $?
+
+        local pkg_dbdir
+        pkg_dbdir="${cachedir}/pkgdb/${abi}"
+
+        update_catalogue "${pkg_dbdir}" "${abi}" >&2 || exit $?
+
+        # Only the catalogue is copied, the chroot keeps its own database of
+        # installed packages.
+        mkdir -p "${mntdir}/var/db/pkg" || exit $?
+        cp -p "${pkg_dbdir}"/repo-*.sqlite "${mntdir}/var/db/pkg" || exit $?
+
+        pkg -c "${mntdir}" -o REPO_AUTOUPDATE=false fetch -y -d -- "$@" >&2 || exit $?
+    else
+        local basedir
+        basedir="$1"
+
+        local freebsd_version
+        freebsd_version=`get_freebsd_version "${basedir}"` || exit $?
+
+        env PAGER=cat freebsd-update \
+            --not-running-from-cron \
+            -b "${basedir}" \
+            -d "${directory}" \
+            --currently-running "${freebsd_version}" \
+                fetch >&2 || exit $?
+    fi
+
+    local after
+    after=`count_files "${count_dir}" "${pattern}"`
+
+    echo $((after-before))
+}
+
+# Updates the shared catalogue when it is missing or older than a day (for
+# example, when 'refresh' is not run from cron(8)). The caller must hold the
+# lock of the package cache.
+update_catalogue()
+{
+    local pkg_dbdir
+    pkg_dbdir="$1"
+
+    local abi
+    abi="$2"
+
+    if [ -n "`find "${pkg_dbdir}" -maxdepth 1 -name .updated -mtime -1 2> /dev/null`" ]; then
+        return 0
+    fi
+
+    mkdir -p "${pkg_dbdir}" || return $?
+
+    info "Updating the package catalogue (ABI:${abi})"
+
+    pkg \
+        -o ABI="${abi}" \
+        -o PKG_DBDIR="${pkg_dbdir}" \
+        `get_repos_args` \
+            update || return $?
+
+    touch "${pkg_dbdir}/.updated"
+}
+
+# Use the same repositories as the VMs.
+get_repos_args()
+{
+    local repos_dir
+    repos_dir="${BASEDIR}/files/usr/local/etc/pkg/repos"
+
+    if [ -d "${repos_dir}" ]; then
+        echo "-R ${repos_dir}"
+    fi
+}
+
+get_freebsd_version()
+{
+    local basedir
+    basedir="$1"
+
+    chroot "${basedir}" freebsd-version | sed -Ee 's/\-p[0-9]+$//'
+}
+
+count_files()
+{
+    local directory
+    directory="$1"
+
+    local pattern
+    pattern="$2"
+
+    if [ ! -d "${directory}" ]; then
+        echo 0
+        return 0
+    fi
+
+    find "${directory}" -type f -name "${pattern}" | wc -l | tr -d ' '
+}
+
+add_stats()
+{
+    local cachedir
+    cachedir="$1"
+
+    local kind
+    kind="$2"
+
+    local hits
+    hits="$3"
+
+    local misses
+    misses="$4"
+
+    # A single short line, so concurrent appends are not mixed.
+    printf "%d %s %d %d\n" `date +%s` "${kind}" ${hits} ${misses} >> "${cachedir}/stats"
+}
+
+handle_signals()
+{
+    trap '' ${SIGNALS_IGNORED}
+    trap "_ERRLEVEL=\$?; cleanup; exit \${_ERRLEVEL}" EXIT
+    trap "cleanup; exit 70" ${SIGNALS_HANDLED}
+}
+
+ignore_all_signals()
+{
+    trap '' ${SIGNALS_HANDLED} EXIT
+}
+
+restore_signals()
+{
+    trap - ${SIGNALS_HANDLED} ${SIGNALS_IGNORED} EXIT
+}
+
+cleanup()
+{
+    ignore_all_signals
+
+    if [ -n "${GLOBAL_NULLFS_MNTDIR}" ]; then
+        umount -f "${GLOBAL_NULLFS_MNTDIR}"
+    fi
+
+    restore_signals
+}
+
+usage()
+{
+    echo "usage: fetch-cache.sh pkg-install <mount-directory> [<package> ...]"
+    echo "       fetch-cache.sh freebsd-update <directory>"
+    echo "       fetch-cache.sh refresh [-A <abi>]"
+    echo "       fetch-cache.sh stats"
+    echo "       fetch-cache.sh clean"
+}
+
+main "$@"
@@ -0,0 +1,354 @@
+#!/bin/sh
+
+BASEDIR=`dirname -- "$0"` || exit $?
+BASEDIR=`realpath -- "${BASEDIR}"` || exit $?
+
+. "${BASEDIR}/lib.subr"
+. "${BASEDIR}/config.conf"
+
+# Global
+GLOBAL_IMAGE_TMP=
+GLOBAL_MD_DEVICE=
+GLOBAL_MNTDIR=
+GLOBAL_MNTDIR_MOUNTED=false
+GLOBAL_ERROR=true
+
+# Signals
+SIGNALS_IGNORED="SIGALRM SIGVTALRM SIGPROF SIGUSR1 SIGUSR2"
+SIGNALS_HANDLED="SIGHUP SIGINT SIGQUIT SIGTERM SIGXCPU SIGXFSZ"
+
+main()
+{
+    local _o
+    # options
+    local components="${COMPONENTS:-base.txz kernel.txz}"
+    local goldendir="${GOLDENDIR:-${BASEDIR}/golden}"
+    local mntdir="${MNTDIR:-/mnt}"
+    local size="${SIZE:-20G}"
+    local swap="${SWAP:-4G}"
+    local resolv_conf="${RESOLV_CONF:-/etc/resolv.conf}"
+    local force=false
+
+    while getopts ":c:fg:m:r:s:S:" _o; do
+        case "${_o}" in
+            c)
+                components="${OPTARG}"
+                ;;
+            f)
+                force=true
+                ;;
+            g)
+                goldendir="${OPTARG}"
+                ;;
+            m)
+                mntdir="${OPTARG}"
+                ;;
+            r)
+                resolv_conf="${OPTARG}"
+                ;;
+            s)
+                size="${OPTARG}"
+                ;;
+            S)
+                swap="${OPTARG}"
+                ;;
+            *)
+                usage
+                exit ${EX_USAGE}
+                ;;
+        esac
+    done
+    shift $((OPTIND-1))
+
+    if [ $# -gt 0 ]; then
+        usage
+        exit ${EX_USAGE}
+    fi
+
+    swap=`tobytes "${swap}"`
+    size=`tobytes "${size}"`
+
+    local component
+    for component in ${components}; do
+        if [ ! -f "${BASEDIR}/components/${component}" ]; then
+            err "Component '${component}' cannot be found"
+            exit ${EX_NOINPUT}
+        fi
+    done
+
+    local key
+    key=`get_key "${components}" "${size}" "${swap}"` || exit $?
+
+    if [ ! -d "${goldendir}" ]; then
+        mkdir -p "${goldendir}" || exit $?
+    fi
+
+    local image
+    image="${goldendir}/${key}.img"
+
+    # Only one process builds the image. The others wait and use it. The
+    # standard output is reserved for the image path.
+    lockf -k "${image}.lock" \
+        "$0" -b "${image}" "${components}" "${size}" "${swap}" "${resolv_conf}" "${mntdir}" "${force}" >&2 || exit $?
+
+    echo "${image}"
+
+    return ${EX_OK}
+}
+
+build()
+{
+    local image
+    image="$1"
+
+    local components
+    components="$2"
+
+    local size
+    size="$3"
+
+    local swap
+    swap="$4"
+
+    local resolv_conf
+    resolv_conf="$5"
+
+    local mntdir
+    mntdir="$6"
+
+    local force
+    force="$7"
+
+    if [ -f "${image}" ] && ! ${force}; then
+        GLOBAL_ERROR=false
+        return ${EX_OK}
+    fi
+
+    handle_signals
+
+    local pad
+    pad=`tobytes 8m`
+
+    local rootpart_size
+    rootpart_size=$((size-swap))
+
+    info "Building golden image '${image}'"
+
+    local image_tmp
+    image_tmp="${image}.tmp"
+
+    GLOBAL_IMAGE_TMP="${image_tmp}"
+
+    rm -f "${image_tmp}" || exit $?
+    truncate -s $((size+pad)) "${image_tmp}" || exit $?
+
+    local md_device
+    md_device=`mdconfig -at vnode -f "${image_tmp}"` || exit $?
+
+    GLOBAL_MD_DEVICE="${md_device}"
+
+    info "md(4) device is '${md_device}'"
+
+    info "Partitioning"
+
+    gpart create -s gpt "${md_device}" || exit $?
+    gpart add -a 1m -t freebsd-boot -s 512k "${md_device}" || exit $?
+    gpart add -a 1m -t freebsd-swap -s "${swap}b" "${md_device}" || exit $?
+    gpart add -a 1m -t freebsd-ufs -s "${rootpart_size}b" "${md_device}" || exit $?
+    gpart bootcode -b /boot/pmbr -p /boot/gptboot -i 1 "${md_device}" || exit $?
+
+    local rootpart
+    rootpart="/dev/${md_device}p3"
+
+    info "Formatting"
+
+    newfs -U "${rootpart}" || exit $?
+
+    local image_mntdir
+    image_mntdir="${mntdir}/golden.${md_device}"
+
+    GLOBAL_MNTDIR="${image_mntdir}"
+
+    mkdir -p "${image_mntdir}" || exit $?
+
+    info "Mounting ${rootpart} in ${image_mntdir}"
+
+    mount "${rootpart}" "${image_mntdir}" || exit $?
+
+    GLOBAL_MNTDIR_MOUNTED=true
+
+    local component
+    for component in ${components}; do
+        info "Extracting component '${component}'"
+
+        tar -C "${image_mntdir}" -xf "${BASEDIR}/components/${component}" || exit $?
+    done
+
+    info "Writing fstab(5)"
+
+    cat << "EOF" > "${image_mntdir}/etc/fstab"
+/dev/nda0p3        /           ufs         rw        1        1
+/dev/nda0p2        none        swap        sw        0        0
+EOF
+
+    if [ -d "${BASEDIR}/files" ]; then
+        info "Copying ${BASEDIR}/files/ to ${image_mntdir}"
+
+        cp -va "${BASEDIR}/files/" "${image_mntdir}" || exit $?
+    fi
+
+    if [ -f "${image_mntdir}/etc/resolv.conf" ]; then
+        info "Backing up chroot's resolv.conf(5) file"
+
+        cp -a "${image_mntdir}/etc/resolv.conf" "${image_mntdir}/etc/resolv.conf.bak" || exit $?
+    fi
+
+    info "Removing chroot's resolv.conf(5) file"
+
+    chflags 0 "${image_mntdir}/etc/resolv.conf" || exit $?
+    rm -f "${image_mntdir}/etc/resolv.conf" || exit $?
+
+    if [ -f "${resolv_conf}" ]; then
+        info "Copying '${resolv_conf}' as the resolv.conf(5) file"
+
+        cp -a "${resolv_conf}" "${image_mntdir}/etc/resolv.conf" || exit $?
+    else
+        warn "resolv.conf(5) '${resolv_conf}' not found, using OpenDNS nameservers"
+
+        printf "nameserver %s\nnameserver %s\n" \
+            "208.67.222.222" "208.67.220.220" > "${image_mntdir}/etc/resolv.conf" || exit $?
+    fi
+
+    if [ -f "${BASEDIR}/pkg.lst" ]; then
+        info "Installing packages"
+
+        "${BASEDIR}/fetch-cache.sh" pkg-install "${image_mntdir}" `cat "${BASEDIR}/pkg.lst"` || exit $?
+    fi
+
+    info "Updating"
+
+    "${BASEDIR}/fetch-cache.sh" freebsd-update "${image_mntdir}" || exit $?
+
+    if [ -f "${image_mntdir}/etc/resolv.conf.bak" ]; then
+        info "Restoring previous resolv.conf(5) file"
+
+        chflags 0 "${image_mntdir}/etc/resolv.conf" || exit $?
+        rm -f "${image_mntdir}/etc/resolv.conf" || exit $?
+        cp -a "${image_mntdir}/etc/resolv.conf.bak" "${image_mntdir}/etc/resolv.conf" || exit $?
+        chflags 0 "${image_mntdir}/etc/resolv.conf.bak" || exit $?
+        rm -f "${image_mntdir}/etc/resolv.conf.bak" || exit $?
+    fi
+
+    umount "${image_mntdir}" || exit $?
+
+    GLOBAL_MNTDIR_MOUNTED=false
+
+    rmdir "${image_mntdir}" || exit $?
+
+    info "Destroying md(4) device"
+
+    mdconfig -du "${md_device}" || exit $?
+
+    GLOBAL_MD_DEVICE=
+
+    mv "${image_tmp}" "${image}" || exit $?
+
+    info "Golden image '${image}' has been built"
+
+    GLOBAL_ERROR=false
+
+    return ${EX_OK}
+}
+
+# The key changes when anything that ends up in the image changes: the
+# components, pkg.lst, files/ and the disk layout.
+get_key()
+{
+    local components
+    components="$1"
+
+    local size
+    size="$2"
+
+    local swap
+    swap="$3"
+
+    (
+        echo "size=${size}"
+        echo "swap=${swap}"
+
+        local component
+        for component in ${components}; do
+            printf "component=%s:%s\n" "${component}" `sha256 -q "${BASEDIR}/components/${component}"`
+        done
+
+        if [ -f "${BASEDIR}/pkg.lst" ]; then
+            printf "pkg.lst=%s\n" `sha256 -q "${BASEDIR}/pkg.lst"`
+        fi
+
+        if [ -d "${BASEDIR}/files" ]; then
+            (cd "${BASEDIR}/files"; find . -type f -exec sha256 -r {} + | sort)
+        fi
+    ) | sha256 -q
+}
+
+handle_signals()
+{
+    trap '' ${SIGNALS_IGNORED}
+    trap "_ERRLEVEL=\$?; cleanup; exit \${_ERRLEVEL}" EXIT
+    trap "cleanup; exit 70" ${SIGNALS_HANDLED}
+}
+
+ignore_all_signals()
+{
+    trap '' ${SIGNALS_HANDLED} EXIT
+}
+
+restore_signals()
+{
+    trap - ${SIGNALS_HANDLED} ${SIGNALS_IGNORED} EXIT
+}
+
+cleanup()
+{
+    ignore_all_signals
+
+    if ! ${GLOBAL_ERROR}; then
+        restore_signals
+        return 0
+    fi
+
+    info "Cleaning up"
+
+    if [ -n "${GLOBAL_MNTDIR}" ] && [ -d "${GLOBAL_MNTDIR}" ]; then
+        if ${GLOBAL_MNTDIR_MOUNTED}; then
+            umount -f "${GLOBAL_MNTDIR}"
+        fi
+
+        rmdir "${GLOBAL_MNTDIR}"
+    fi
+
+    if [ -n "${GLOBAL_MD_DEVICE}" ] && [ -c "/dev/${GLOBAL_MD_DEVICE}" ]; then
+        mdconfig -du "${GLOBAL_MD_DEVICE}"
+    fi
+
+    if [ -n "${GLOBAL_IMAGE_TMP}" ] && [ -f "${GLOBAL_IMAGE_TMP}" ]; then
+        rm -f "${GLOBAL_IMAGE_TMP}"
+    fi
+
+    restore_signals
+}
+
+usage()
+{
+    echo "golden.sh [-f] [-c <components>] [-g <golden-directory>] [-m <mount-directory>]"
+    echo "          [-r <file>] [-s <size>] [-S <swap-size>]"
+}
+
+# '-b' is used internally to build the image while holding the lock.
+if [ "$1" = "-b" ]; then
+    shift
+    build "$@"
+else
+    main "$@"
+fi
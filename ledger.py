@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import json
+import os
+import sys
+import time
+
+import collector
+import state
+
+BASEDIR = os.path.dirname(os.path.realpath(__file__))
+
+LEDGER_FILE = os.path.join(BASEDIR, ".ledger.json")
+
+# See sysexits(3).
+EX_OK = 0
+EX_USAGE = 64
+EX_NOINPUT = 66
+
+def main(*args):
+    if len(args) < 2:
+        usage()
+        return EX_USAGE
+
+    cmd = args[1]
+
+    if cmd == "add" and len(args) == 3:
+        if not add(args[2]):
+            err(f"Cannot get the limits of '{args[2]}'")
+            return EX_NOINPUT
+    elif cmd == "remove" and len(args) == 3:
+        remove(args[2])
+    elif cmd == "reconcile" and len(args) == 2:
+        print(json.dumps(reconcile().todict(), indent=4))
+    elif cmd == "show" and len(args) == 2:
+        print(json.dumps(load(), indent=4))
+    elif cmd == "total" and len(args) == 2:
+        print(json.dumps(get_total().todict(), indent=4))
+    else:
+        usage()
+        return EX_USAGE
+
+    return EX_OK
+
+def add(vm):
+    vm_info = collector.get_vm_info(vm)
+
+    if vm_info is None:
+        return False
+
+    vm_limits = collector.parse_limits(vm_info)
+
+    with state.lock(LEDGER_FILE):
+        ledger = load()
+
+        update(ledger, vm, vm_limits.todict())
+
+        state.save(LEDGER_FILE, ledger)
+
+    return True
+
+def remove(vm):
+    with state.lock(LEDGER_FILE):
+        ledger = load()
+
+        update(ledger, vm, None)
+
+        state.save(LEDGER_FILE, ledger)
+
+def update(ledger, vm, vm_limits):
+    total = ledger["total"]
+
+    old_limits = ledger["vms"].pop(vm, None)
+
+    if old_limits is not None:
+        total["memory"] -= old_limits["memory"]
+        total["storage"] -= old_limits["storage"]
+
+    if vm_limits is not None:
+        ledger["vms"][vm] = vm_limits
+
+        total["memory"] += vm_limits["memory"]
+        total["storage"] += vm_limits["storage"]
+
+def reconcile():
+    with state.lock(LEDGER_FILE):
+        limits = collector.collect_limits()
+
+        ledger = {
+            "reconciled" : time.time(),
+            "vms" : { vm : vm_limits.todict() for vm, vm_limits in limits.items() },
+            "total" : collector.total_limits(limits).todict()
+        }
+
+        state.save(LEDGER_FILE, ledger)
+
+    return collector.Limits.fromdict(ledger["total"])
+
+def get_total(max_age=None):
+    ledger = state.load(LEDGER_FILE)
+
+    if ledger is None:
+        return reconcile()
+
+    if max_age is not None and \
+            (time.time() - ledger["reconciled"]) >= max_age:
+        return reconcile()
+
+    return collector.Limits.fromdict(ledger["total"])
+
+def load():
+    return state.load(LEDGER_FILE, {
+        "reconciled" : 0,
+        "vms" : {},
+        "total" : {
+            "memory" : 0,
+            "storage" : 0
+        }
+    })
+
+def err(msg):
+    print(f"###> {msg} <###", file=sys.stderr)
+
+def usage():
+    print("usage: ledger.py add <vm>")
+    print("       ledger.py remove <vm>")
+    print("       ledger.py reconcile")
+    print("       ledger.py show")
+    print("       ledger.py total")
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv))
@@ -53,6 +53,8 @@ if [ -n "${TAGS}" ]; then
     for tag in ${TAGS}; do
         printf "%s\n" "${tag}"
     done > "${vm_dir}/.tags" || exit $?
+
+    "${WRKDIR}/tagindex.py" add "${vm_name}" ${TAGS}
 fi
 
 if [ -n "${BLOCKSTORAGE}" ]; then
@@ -0,0 +1,50 @@
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+
+# The lock file is compatible with lockf(1), so shell scripts can use
+# 'lockf -k <file>.lock' to serialize with the Python code.
+@contextlib.contextmanager
+def lock(path):
+    with open(f"{path}.lock", "a") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+def load(path, default=None):
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return default
+    except ValueError:
+        # A corrupted file is treated as a missing one.
+        return default
+
+def save(path, data):
+    (dirname, basename) = os.path.split(path)
+
+    (fd, tmpfile) = tempfile.mkstemp(prefix=f".{basename}.", dir=dirname)
+
+    try:
+        with os.fdopen(fd, "w") as fp:
+            json.dump(data, fp)
+
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(tmpfile, path)
+    except:
+        os.unlink(tmpfile)
+        raise
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import json
+import os
+import re
+import sys
+
+import collector
+import state
+
+BASEDIR = os.path.dirname(os.path.realpath(__file__))
+
+INDEX_FILE = os.path.join(BASEDIR, ".tags.json")
+
+# See sysexits(3).
+EX_OK = 0
+EX_USAGE = 64
+
+def main(*args):
+    if len(args) < 2:
+        usage()
+        return EX_USAGE
+
+    cmd = args[1]
+
+    if cmd == "add" and len(args) >= 3:
+        add(args[2], args[3:])
+    elif cmd == "remove" and len(args) == 3:
+        remove(args[2])
+    elif cmd == "find" and len(args) >= 3:
+        exact = False
+        patterns = list(args[2:])
+
+        # '--' ends the options, so a pattern may start with '-'.
+        while patterns and patterns[0].startswith("-"):
+            option = patterns.pop(0)
+
+            if option == "--":
+                break
+            elif option == "-e":
+                exact = True
+            else:
+                usage()
+                return EX_USAGE
+
+        if not patterns:
+            usage()
+            return EX_USAGE
+
+        for vm in find(patterns, exact):
+            print(vm)
+    elif cmd == "rebuild" and len(args) == 2:
+        rebuild()
+    elif cmd == "show" and len(args) == 2:
+        index = state.load(INDEX_FILE)
+
+        if index is None:
+            index = scan()
+
+        print(json.dumps(index, indent=4))
+    else:
+        usage()
+        return EX_USAGE
+
+    return EX_OK
+
+def add(vm, tags):
+    with state.lock(INDEX_FILE):
+        index = state.load(INDEX_FILE)
+
+        if index is None:
+            index = scan()
+
+        update(index, vm, tags)
+
+        state.save(INDEX_FILE, index)
+
+def remove(vm):
+    with state.lock(INDEX_FILE):
+        index = state.load(INDEX_FILE)
+
+        if index is None:
+            index = scan()
+
+        update(index, vm, [])
+
+        state.save(INDEX_FILE, index)
+
+def update(index, vm, tags):
+    for tag in index["vms"].pop(vm, []):
+        vms = index["tags"].get(tag, [])
+
+        if vm in vms:
+            vms.remove(vm)
+
+        if not vms:
+            index["tags"].pop(tag, None)
+
+    if not tags:
+        return
+
+    index["vms"][vm] = sorted(set(tags))
+
+    for tag in index["vms"][vm]:
+        index["tags"].setdefault(tag, []).append(vm)
+
+def rebuild():
+    with state.lock(INDEX_FILE):
+        index = scan()
+
+        state.save(INDEX_FILE, index)
+
+    return index
+
+def scan():
+    index = {
+        "tags" : {},
+        "vms" : {}
+    }
+
+    vm_bhyve_dir = collector.get_vm_dir()
+
+    if vm_bhyve_dir is None:
+        return index
+
+    for vm in collector.get_vm_machines(vm_bhyve_dir):
+        tags_file = os.path.join(vm_bhyve_dir, vm, ".tags")
+
+        if not os.path.isfile(tags_file):
+            continue
+
+        with open(tags_file) as fd:
+            tags = fd.read().split()
+
+        update(index, vm, tags)
+
+    return index
+
+# Each pattern is a Python regular expression (see re) that may match any part
+# of a tag, unless 'exact' is used.
+def find(patterns, exact=False):
+    index = state.load(INDEX_FILE)
+
+    if index is None:
+        index = rebuild()
+
+    vms = set()
+
+    if exact:
+        for pattern in patterns:
+            vms.update(index["tags"].get(pattern, []))
+    else:
+        regexes = [re.compile(pattern) for pattern in patterns]
+
+        for tag, tag_vms in index["tags"].items():
+            for regex in regexes:
+                if regex.search(tag):
+                    vms.update(tag_vms)
+                    break
+
+    if not vms:
+        return []
+
+    # The index may contain VMs whose creation failed after storing the tags.
+    vm_bhyve_dir = collector.get_vm_dir()
+
+    if vm_bhyve_dir is not None:
+        vms = [vm for vm in vms if os.path.isdir(os.path.join(vm_bhyve_dir, vm))]
+
+    return sorted(vms)
+
+def usage():
+    print("usage: tagindex.py add <vm> [<tag> ...]")
+    print("       tagindex.py remove <vm>")
+    print("       tagindex.py find [-e] [--] <pattern> [<pattern> ...]")
+    print("       tagindex.py rebuild")
+    print("       tagindex.py show")
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv))